@@ -0,0 +1,57 @@
+""" Benchmark of the anomaly flagging: the pandas rolling columns against the fused flag_kernel, on a year
+of minute errors, plus the grouping of the anomalous minutes into episodes.
+
+Run from the repository root:  python -m Benchmarks.bench_anomaly_flag [days]
+"""
+import sys
+import time
+import numpy as np
+import pandas as pd
+from Model.results import flag_kernel, anomaly_episodes, ROLLING_WINDOW
+
+CUTOFFS = (0.2, 0.6, 0.22)  # error, DC and AE cutoff
+
+
+def legacy_flag(df: pd.DataFrame, error_cutoff: float, dc_cutoff: float, ae_cutoff: float):
+    df['AE'] = df['Error'].rolling(ROLLING_WINDOW, min_periods=1).sum() / ROLLING_WINDOW
+    df['flag'] = np.where(df['Error'] > error_cutoff, 1, 0)
+    df['DC'] = df['flag'].rolling(ROLLING_WINDOW, min_periods=1).sum() / ROLLING_WINDOW
+    df.drop('flag', axis=1, inplace=True)
+    df['Anomaly'] = np.where((df['DC'] > dc_cutoff) & (df['AE'] > ae_cutoff), 1, 0)
+    return df[df['Anomaly'] == 1].index
+
+
+if __name__ == "__main__":
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 365
+    rng = np.random.default_rng(0)
+    n = days * 24 * 60
+    error = rng.gamma(2, 0.05, n).astype(np.float32)
+    for start in rng.integers(0, n - 100, days):  # About one disturbance a day
+        error[start:start + rng.integers(5, 60)] += 0.5
+    df = pd.DataFrame({'Error': error.astype(np.float64)}, index=pd.date_range("2024-01-01", periods=n, freq="min"))
+
+    start = time.perf_counter()
+    expected = legacy_flag(df.copy(), *CUTOFFS)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ae, dc, anomaly = flag_kernel(df['Error'].to_numpy(), *CUTOFFS)
+    kernel_time = time.perf_counter() - start
+    assert df.index[anomaly].equals(expected)
+
+    # Missing errors, e.g. from an empty first cell of an export, are skipped like the pandas rolling sums do
+    gaps = df.copy()
+    gaps.iloc[[0, 1, 2, 3, 4, 5, 6, n // 2], 0] = np.nan
+    gap_ae, _, gap_anomaly = flag_kernel(gaps['Error'].to_numpy(), *CUTOFFS)
+    gap_expected = legacy_flag(gaps, *CUTOFFS)
+    assert gaps.index[gap_anomaly].equals(gap_expected)
+    assert np.allclose(gap_ae, gaps['AE'], equal_nan=True)
+
+    start = time.perf_counter()
+    episodes = anomaly_episodes(df.assign(Anomaly=anomaly.view(np.int8)))
+    episode_time = time.perf_counter() - start
+
+    print(f"{n} rows, {len(expected)} anomalous minutes in {len(episodes)} episodes")
+    print(f"pandas rolling:  {legacy_time:6.3f} s")
+    print(f"flag_kernel:     {kernel_time:6.3f} s  ({legacy_time / kernel_time:4.1f}x)")
+    print(f"episodes:        {episode_time:6.3f} s")
@@ -0,0 +1,48 @@
+""" Benchmark of the weekend filter: the old iterrows loop against the vectorized mask.
+
+Run from the repository root:  python -m Benchmarks.bench_clear_weekends
+"""
+import time
+import numpy as np
+import pandas as pd
+from Model.data_preprocessor import clearWeekends
+
+
+def legacy_clearWeekends(df: pd.DataFrame) -> pd.DataFrame:
+    """ The previous row-by-row implementation, kept here only as the baseline"""
+    toDrop = []
+    for ind, row in df.iterrows():
+        date = row["Date"]
+        day = date.weekday()
+        if day == 4 and date.hour > 23:
+            toDrop.append(ind)
+        elif day == 5:
+            toDrop.append(ind)
+        elif day == 6 and date.hour <= 23:
+            toDrop.append(ind)
+    return df.drop(index=toDrop)
+
+
+def synthetic_year(rows: int = 365 * 24 * 60) -> pd.DataFrame:
+    dates = pd.date_range("2023-01-01", periods=rows, freq="min")
+    return pd.DataFrame({"Date": dates, "Value": np.random.default_rng(0).random(rows)})
+
+
+def timed(func, df):
+    start = time.perf_counter()
+    out = func(df.copy())
+    return out, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    year = synthetic_year()
+    # The loop is far too slow for a full year, so it is timed on one month and extrapolated as rows/s
+    month = year.iloc[:31 * 24 * 60]
+
+    legacy, legacyTime = timed(legacy_clearWeekends, month)
+    fast, fastTime = timed(clearWeekends, year)
+    assert legacy.index.equals(clearWeekends(month.copy()).index)
+
+    print(f"iterrows loop : {len(month) / legacyTime:>14,.0f} rows/s ({len(month):,} rows)")
+    print(f"vectorized    : {len(year) / fastTime:>14,.0f} rows/s ({len(year):,} rows)")
+    print(f"speed-up      : {(len(year) / fastTime) / (len(month) / legacyTime):>14,.0f}x")
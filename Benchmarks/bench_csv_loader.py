@@ -0,0 +1,46 @@
+""" Benchmark of the CSV ingestion: reading the whole export twice against the streaming reader.
+
+Run from the repository root:  python -m Benchmarks.bench_csv_loader [days] [extra_tags]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+from Benchmarks.historian import generate, write_csv
+from Model.data_loader import CSV_HEADER, CSVreader, CSVsplitterMerger
+
+
+def legacy_load(path: str):
+    with open(path) as f:
+        lines = f.readlines()
+    start = next(i for i, line in enumerate(lines) if line.startswith(CSV_HEADER))
+    return CSVsplitterMerger(pd.read_csv(path, skiprows=start))
+
+
+def stream_load(path: str):
+    return CSVsplitterMerger(CSVreader(path))
+
+
+def measure(func, path):
+    tracemalloc.start()
+    start = time.perf_counter()
+    out = func(path)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return out, elapsed, peak
+
+
+if __name__ == "__main__":
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    extraTags = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "export.csv")
+        write_csv(path, generate(days, extraTags)[0])
+        size = os.path.getsize(path) / 2 ** 20
+        print(f"{days} days, {4 + extraTags} tags, {size:,.0f} MiB on disk")
+        for name, func in [("read twice + merge", legacy_load), ("streaming reader", stream_load)]:
+            out, elapsed, peak = measure(func, path)
+            print(f"{name:<20}: {elapsed:7.2f} s, peak {peak / 2 ** 20:8.1f} MiB, {out.shape}")
@@ -0,0 +1,27 @@
+""" Benchmark of the timestamp conversion: regex month replacement + inferred parse against parseDutchDates.
+
+Run from the repository root:  python -m Benchmarks.bench_date_parser [rows]
+"""
+import sys
+import time
+import numpy as np
+import pandas as pd
+from Model.data_loader import DUTCH_MONTHS, parseDutchDates
+
+
+def legacy_parse(dates: pd.Series) -> pd.Series:
+    replDict = {f" {month} ": f"-{number}-" for month, number in DUTCH_MONTHS.items()}
+    return pd.to_datetime(dates.replace(to_replace=replDict, regex=True), dayfirst=True)
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 365 * 24 * 60
+    dates = pd.date_range("2024-01-01", periods=rows, freq="min")
+    text = pd.Series(dates.strftime("%d ") + np.array(list(DUTCH_MONTHS))[dates.month - 1] + dates.strftime(" %Y %H:%M:%S"))
+
+    for name, func in [("regex + inference", legacy_parse), ("parseDutchDates", parseDutchDates)]:
+        start = time.perf_counter()
+        parsed = func(text)
+        elapsed = time.perf_counter() - start
+        assert (parsed.to_numpy() == dates.to_numpy()).all()
+        print(f"{name:<18}: {elapsed:6.2f} s ({rows / elapsed:,.0f} rows/s)")
@@ -0,0 +1,64 @@
+""" Benchmark of the inference runtimes: startup time, latency per batch and peak memory of the Keras model
+against its TFLite exports. Every runtime runs in a fresh process, so the import costs are measured too and the
+peak RSS is that of the whole process, imports and loading included.
+
+Export the models first:  python -m Model.model_export normal_operation.csv --quantization float16 int8
+Run from the repository root:  python -m Benchmarks.bench_inference_runtime [threshold]
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+from Model.instrumentation import peak_rss
+
+BATCH_SIZES = (1, 256, 4096)
+REPEATS = 20
+
+
+def child(runtime: str, pressure_threshold: float):
+    """ Loads one runtime and times it, the results are printed as JSON for the parent"""
+    start = time.perf_counter()
+    from Model.model_registry import registry
+    from Model.results import _error_function
+    model = registry.get_predictor(pressure_threshold, runtime)
+    window_error = getattr(model, "window_error", None) or _error_function(model)
+    window_error(np.zeros((1,) + tuple(model.input_shape[1:]), dtype=np.float32))  # First call compiles/allocates
+    result = {"startup": time.perf_counter() - start, "tensorflow": "tensorflow" in sys.modules, "latency": {}}
+
+    rng = np.random.default_rng(0)
+    for batch_size in BATCH_SIZES:
+        batch = rng.random((batch_size,) + tuple(model.input_shape[1:]), dtype=np.float32)
+        np.asarray(window_error(batch))
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            np.asarray(window_error(batch))
+        result["latency"][batch_size] = (time.perf_counter() - start) / REPEATS
+    result["peak_rss"] = peak_rss()  # Cumulative over the process, None where the platform does not report it
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        child(sys.argv[2], float(sys.argv[3]))
+        sys.exit(0)
+
+    from Model.model_registry import RUNTIMES, tflite_path
+    pressure_threshold = float(sys.argv[1]) if len(sys.argv) > 1 else -0.25
+    env = dict(os.environ, TF_CPP_MIN_LOG_LEVEL="3")
+
+    print(f"Threshold {pressure_threshold}, {os.cpu_count()} CPUs, latency per batch of windows")
+    print(f"{'runtime':16}{'startup':>9}{'process peak RSS':>18}"
+          + "".join(f"{f'batch {n}':>13}" for n in BATCH_SIZES) + "  TensorFlow imported")
+    for runtime in RUNTIMES:
+        if runtime != "keras" and not os.path.isfile(tflite_path(pressure_threshold, runtime.partition("-")[2] or None)):
+            print(f"{runtime:16}not exported")
+            continue
+        output = subprocess.run([sys.executable, "-m", "Benchmarks.bench_inference_runtime", "--child", runtime,
+                                 str(pressure_threshold)], capture_output=True, text=True, env=env, check=True)
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        rss = f"{result['peak_rss'] / 2 ** 20:16.0f}MB" if result["peak_rss"] is not None else f"{'-':>18}"
+        print(f"{runtime:16}{result['startup']:8.2f}s{rss}"
+              + "".join(f"{result['latency'][str(n)] * 1e3:11.2f}ms" for n in BATCH_SIZES)
+              + f"  {result['tensorflow']}")
@@ -0,0 +1,36 @@
+""" Scaling benchmark of score_files: the same set of exports scored with 1, 2, 4 and 8 worker processes.
+
+Run from the repository root:  python -m Benchmarks.bench_parallel [files] [days]
+"""
+import os
+import sys
+import tempfile
+import time
+from Benchmarks.historian import generate, write_csv
+from Model import data_cache
+from Model.model_registry import THRESHOLDS
+from UI_files.model_handler import score_files
+
+
+if __name__ == "__main__":
+    nFiles = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 14
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i in range(nFiles):
+            paths.append(os.path.join(tmp, f"export_{i}.csv"))
+            write_csv(paths[-1], generate(days, seed=i)[0])
+
+        timings = {}
+        for workers in (1, 2, 4, 8):
+            # Every worker count starts from a cold dataset cache, the workers read the directory from the environment
+            data_cache.CACHE_DIR = os.environ["ADS_CACHE_DIR"] = os.path.join(tmp, f"cache_{workers}")
+            start = time.perf_counter()
+            results = list(score_files(paths, THRESHOLDS, workers=workers))
+            timings[workers] = time.perf_counter() - start
+            assert [(r.file_path, r.pressure_threshold) for r in results] == [(p, t) for p in paths for t in THRESHOLDS]
+            assert not any(r.failure for r in results)
+
+        print(f"{nFiles} files x {len(THRESHOLDS)} thresholds, {days} days each, {os.cpu_count()} CPUs")
+        for workers, elapsed in timings.items():
+            print(f"{workers} workers: {elapsed:7.1f} s  ({timings[1] / elapsed:4.2f}x)")
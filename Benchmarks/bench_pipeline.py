@@ -0,0 +1,212 @@
+""" Benchmark suite of the scoring pipeline on synthetic historian exports (see historian.py).
+
+Every stage is timed (wall and CPU time, best of --repeat runs) and memory profiled in a separate run: the peak
+of the Python and numpy allocations made by the stage, traced by tracemalloc, and how much the stage raised the
+peak RSS of the process, which also covers TensorFlow. The peak RSS itself is a high-water mark of the whole
+run so far, it is saved as well but labelled cumulative. The results are saved as JSON, --compare prints the change against an earlier run.
+
+Run from the repository root:
+    python -m Benchmarks.bench_pipeline --sizes week month year --formats csv xlsx
+    python -m Benchmarks.bench_pipeline --sizes week --compare Benchmarks/results/<earlier run>.json
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+from Model.instrumentation import peak_rss
+
+SIZES = {"week": 7, "month": 30, "year": 365}  # Days of data
+STAGES = ["data_loader", "data_loader (cached)", "clearWeekends", "read_initial_data", "scaled_predict",
+          "timelagged", "predict_results", "anomaly_flag"]
+REGRESSION_RATIO = 1.2  # --compare reports stages that became this much slower
+RESULTS_DIR = os.path.join("Benchmarks", "results")
+
+
+def _megabytes(value, width: int) -> str:
+    """ Bytes as right aligned MB, "-" when not measured"""
+    return f"{value / 2 ** 20:{width - 2}.1f}MB" if value is not None else f"{'-':>{width}}"
+
+
+def _size(result) -> int:
+    """ Rows of a stage result, windows for an array"""
+    return len(result) if hasattr(result, "__len__") else 0
+
+
+def run_stages(file_path: str, pressure_threshold: float, batch_size: int, measure):
+    """ Runs the pipeline stage by stage, measure(stage, function, *args) runs a stage and returns its result"""
+    from Model import data_cache
+    from Model.data_loader import data_loader
+    from Model.data_preprocessor import clearWeekends, read_initial_data, scaled_predict, timelagged
+    from Model.model_registry import registry
+    from Model.results import predict_results, anomaly_flag
+
+    data_cache.clear()
+    df = measure("data_loader", data_loader, file_path, False)
+    data_loader(file_path)  # Fills the cache
+    measure("data_loader (cached)", data_loader, file_path)
+    df = measure("clearWeekends", clearWeekends, df)
+    df = measure("read_initial_data", read_initial_data, df)
+    scaled = measure("scaled_predict", scaled_predict, df, pressure_threshold)
+    windows = measure("timelagged", timelagged, scaled, registry.get_model(pressure_threshold).input_shape[1])
+    error_df = measure("predict_results", predict_results, df, windows, pressure_threshold, batch_size)
+    measure("anomaly_flag", anomaly_flag, error_df, pressure_threshold)
+
+
+def benchmark_file(file_path: str, pressure_threshold: float, batch_size: int = 4096, repeat: int = 3):
+    """
+    Times and memory profiles every stage on one export
+
+    Args:
+        file_path (str): CSV or Excel export
+        pressure_threshold (float): Model the data is scored with
+        batch_size (int): Windows per inference batch
+        repeat (int): Timing runs, the fastest run of each stage is kept
+
+    Returns:
+        stages (dict): Stage -> wall and CPU seconds, length of the result (anomalies for anomaly_flag),
+            traced peak, rise of the peak RSS during the stage and the cumulative peak RSS after it in bytes
+            (the RSS values are None where the platform does not report them)
+    """
+    stages = {stage: {"wall": float("inf")} for stage in STAGES}
+
+    def timed(stage, function, *args):
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = function(*args)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        if wall < stages[stage]["wall"]:
+            stages[stage].update(wall=wall, cpu=cpu, rows=_size(result))
+        return result
+
+    def profiled(stage, function, *args):
+        tracemalloc.reset_peak()
+        held = tracemalloc.get_traced_memory()[0]  # The inputs, not counted against the stage
+        before = peak_rss()
+        result = function(*args)
+        after = peak_rss()  # High-water mark of the process, only a rise is caused by this stage
+        stages[stage].update(traced_peak=tracemalloc.get_traced_memory()[1] - held,
+                             rss_increase=after - before if after is not None else None, peak_rss=after)
+        return result
+
+    for _ in range(repeat):
+        run_stages(file_path, pressure_threshold, batch_size, timed)
+    tracemalloc.start()
+    try:
+        run_stages(file_path, pressure_threshold, batch_size, profiled)
+    finally:
+        tracemalloc.stop()
+    return stages
+
+
+def metadata(args) -> dict:
+    """ Version and machine of a run, so results of different commits can be told apart"""
+    import pandas
+    import tensorflow
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                                    text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        revision, dirty = None, None
+    return {"date": datetime.now().isoformat(timespec="seconds"), "revision": revision, "dirty": dirty,
+            "python": platform.python_version(), "numpy": np.__version__, "pandas": pandas.__version__,
+            "tensorflow": tensorflow.__version__, "platform": platform.platform(), "cpus": os.cpu_count(),
+            "threshold": args.threshold, "batch_size": args.batch_size, "repeat": args.repeat,
+            "anomaly_rate": args.anomaly_rate, "extra_tags": args.extra_tags, "seed": args.seed}
+
+
+def compare(old: dict, new: dict) -> list:
+    """ Prints the wall time of every stage against an earlier run, returns the stages that became slower"""
+    old_runs = {(run["size"], run["format"]): run["stages"] for run in old["runs"]}
+    print(f"\nAgainst {old['meta'].get('revision')} of {old['meta'].get('date')}:")
+    print(f"{'size':7}{'format':8}{'stage':22}{'before':>10}{'after':>10}{'ratio':>8}")
+    regressions = []
+    for run in new["runs"]:
+        before = old_runs.get((run["size"], run["format"]))
+        if before is None:
+            continue
+        for stage, result in run["stages"].items():
+            if stage not in before:
+                continue
+            ratio = result["wall"] / before[stage]["wall"] if before[stage]["wall"] else float("inf")
+            slower = ratio > REGRESSION_RATIO
+            if slower:
+                regressions.append((run["size"], run["format"], stage, ratio))
+            print(f"{run['size']:7}{run['format']:8}{stage:22}{before[stage]['wall']:9.3f}s{result['wall']:9.3f}s"
+                  f"{ratio:7.2f}x{'  slower' if slower else ''}")
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Time and memory profile the pipeline stages")
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES))
+    parser.add_argument("--formats", nargs="+", choices=["csv", "xlsx"], default=["csv", "xlsx"])
+    parser.add_argument("--threshold", type=float, default=-0.25)
+    parser.add_argument("--anomaly-rate", type=float, default=0.01)
+    parser.add_argument("--extra-tags", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--data-dir", help="Keep the generated exports here and reuse them in later runs")
+    parser.add_argument("--output", help="JSON file, by default Benchmarks/results/pipeline_<date>_<revision>.json")
+    parser.add_argument("--compare", help="JSON file of an earlier run")
+    args = parser.parse_args()
+
+    from Benchmarks.historian import generate, write_csv, write_xlsx
+    from Model import data_cache
+    from Model.model_registry import registry
+    from Model.results import reconstruction_errors
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="bench_pipeline_")
+    os.makedirs(data_dir, exist_ok=True)
+    data_cache.CACHE_DIR = tempfile.mkdtemp(prefix="bench_pipeline_cache_")  # Leaves the user's cache alone
+
+    start = time.perf_counter()
+    model = registry.get_model(args.threshold)
+    registry.get_scaler(args.threshold)
+    for warm_up in (args.batch_size, 1):  # The forward pass is traced on the first call, keep that out of the timings
+        list(reconstruction_errors(model, np.zeros((warm_up,) + tuple(model.input_shape[1:]), dtype=np.float32),
+                                   args.batch_size))
+    results = {"meta": metadata(args), "model_load": time.perf_counter() - start, "runs": []}
+
+    for size in args.sizes:
+        frame = None
+        for file_format in args.formats:
+            file_path = os.path.join(data_dir, f"historian_{size}_{args.extra_tags}_{args.anomaly_rate}_{args.seed}"
+                                               f".{file_format}")
+            if not os.path.isfile(file_path):
+                if frame is None:
+                    frame, _ = generate(SIZES[size], args.extra_tags, args.anomaly_rate, seed=args.seed)
+                (write_csv if file_format == "csv" else write_xlsx)(file_path, frame)
+            stages = benchmark_file(file_path, args.threshold, args.batch_size, args.repeat)
+            results["runs"].append({"size": size, "days": SIZES[size], "format": file_format,
+                                    "file_bytes": os.path.getsize(file_path), "stages": stages})
+
+            print(f"\n{size} ({SIZES[size]} days), {file_format}, {os.path.getsize(file_path) / 2 ** 20:.1f} MB")
+            print(f"{'stage':22}{'wall':>9}{'cpu':>9}{'rows':>10}{'traced peak':>13}{'RSS increase':>14}"
+                  f"{'peak RSS (cumulative)':>23}")
+            for stage, result in stages.items():
+                print(f"{stage:22}{result['wall']:8.3f}s{result['cpu']:8.3f}s{result['rows']:10}"
+                      f"{_megabytes(result['traced_peak'], 13)}{_megabytes(result['rss_increase'], 14)}"
+                      f"{_megabytes(result['peak_rss'], 23)}")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"pipeline_{datetime.now():%Y%m%d_%H%M%S}_"
+                                                      f"{results['meta']['revision'] or 'unknown'}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,55 @@
+""" Benchmark of the long-to-wide reshape: the per-tag merge chain against the single pivot.
+
+Run from the repository root:  python -m Benchmarks.bench_pivot [rows_per_tag]
+"""
+import sys
+import time
+import numpy as np
+import pandas as pd
+from Model.data_loader import CSVsplitterMerger
+
+
+def legacy_CSVsplitterMerger(df: pd.DataFrame):
+    """ The previous filter/regex/merge implementation, kept here only as the baseline"""
+    tags = pd.unique(df["TagName"])
+    frames = []
+    for tag in tags:
+        frame = df.loc[df["TagName"] == tag]
+        frame = frame.rename(columns={"Value": tag})
+        frame = frame.drop(columns=["TagName"])
+        frame[tag] = frame[tag].replace(to_replace={",": "."}, regex=True)
+        frame[tag] = pd.to_numeric(frame[tag])
+        frames.append(frame)
+
+    df_final = frames[0]
+    for i in range(1, len(frames)):
+        df_final = df_final.merge(frames[i], on="DateTime")
+    return df_final
+
+
+def long_frame(n_tags: int, rows_per_tag: int) -> pd.DataFrame:
+    stamps = pd.date_range("2024-01-01", periods=rows_per_tag, freq="min").strftime("%d-%m-%Y %H:%M:%S")
+    values = np.char.replace(np.round(np.random.default_rng(0).random(rows_per_tag * n_tags), 3).astype(str), ".", ",")
+    return pd.DataFrame({
+        "DateTime": np.tile(stamps, n_tags),
+        "TagName": np.repeat([f"TAG{i:03d}" for i in range(n_tags)], rows_per_tag),
+        "Value": values,
+    })
+
+
+def timed(func, df):
+    start = time.perf_counter()
+    out = func(df)
+    return out, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    rowsPerTag = int(sys.argv[1]) if len(sys.argv) > 1 else 7 * 24 * 60
+    pd.options.mode.chained_assignment = None
+    for nTags in (4, 50, 500):
+        df = long_frame(nTags, rowsPerTag)
+        old, oldTime = timed(legacy_CSVsplitterMerger, df)
+        new, newTime = timed(CSVsplitterMerger, df)
+        assert np.allclose(old.iloc[:, 1:].to_numpy(), new.iloc[:, 1:].to_numpy())
+        print(f"{nTags:>3} tags, {len(df):>9,} rows: merge chain {oldTime:7.2f} s, pivot {newTime:6.2f} s"
+              f" ({oldTime / newTime:5.1f}x)")
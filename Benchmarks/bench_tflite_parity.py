@@ -0,0 +1,53 @@
+""" Check of the TFLite exports against the Keras models on a week of synthetic historian data (see historian.py):
+the float32 and float16 exports have to stay within PARITY_TOLERANCE of the Keras errors. The int8 variants
+("dynamic" and "int8") can drift further, they are reported but not asserted. The time of every runtime is
+reported as well, exports that are not there are skipped.
+
+Export the models first:  python -m Model.model_export normal_operation.csv --quantization float16 dynamic int8
+Run from the repository root:  python -m Benchmarks.bench_tflite_parity [days]
+"""
+import os
+import sys
+import tempfile
+import time
+from Benchmarks.historian import generate, write_csv
+from Model.model_export import QUANTIZATIONS, check_parity, prepared_windows
+from Model.model_registry import THRESHOLDS, registry, tflite_path
+from Model.results import reconstruction_errors
+
+ASSERTED = (None, "float16")  # Quantizations that must match Keras, see PARITY_TOLERANCE
+
+
+def timed_errors(model, windows) -> float:
+    """ Seconds to compute the errors of all windows, after a first call that compiles/allocates"""
+    list(reconstruction_errors(model, windows[:1]))
+    start = time.perf_counter()
+    for _ in reconstruction_errors(model, windows):
+        pass
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+    frame, _ = generate(days, anomaly_rate=0.01)
+    with tempfile.TemporaryDirectory() as data_dir:
+        file_path = os.path.join(data_dir, "historian.csv")
+        write_csv(file_path, frame)
+
+        checked = 0
+        for pressure_threshold in THRESHOLDS:
+            windows = prepared_windows(file_path, pressure_threshold)
+            keras_time = timed_errors(registry.get_model(pressure_threshold), windows)
+            print(f"[{pressure_threshold}] {len(windows)} windows, keras {keras_time:.3f} s")
+            for quantization in QUANTIZATIONS:
+                if not os.path.isfile(tflite_path(pressure_threshold, quantization)):
+                    continue
+                runtime = "tflite" + (f"-{quantization}" if quantization else "")
+                difference, agreement, ok = check_parity(pressure_threshold, windows, quantization)
+                tflite_time = timed_errors(registry.get_predictor(pressure_threshold, runtime), windows)
+                print(f"[{pressure_threshold}] {runtime:16}{tflite_time:7.3f} s, max error difference "
+                      f"{difference:.2e}, flags agree {agreement:.2%}, {'ok' if ok else 'ABOVE TOLERANCE'}")
+                if quantization in ASSERTED:
+                    assert ok, f"{runtime} export of the {pressure_threshold} model is above PARITY_TOLERANCE"
+                    checked += 1
+    assert checked, "No float32 or float16 TFLite exports found, run python -m Model.model_export first"
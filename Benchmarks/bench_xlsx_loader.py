@@ -0,0 +1,58 @@
+""" Benchmark of the Excel ingestion: the two read_excel passes against the single-pass XLSXreader.
+
+Run from the repository root:  python -m Benchmarks.bench_xlsx_loader [days]
+"""
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import openpyxl
+from Model.data_loader import REQUIRED_COLUMNS, XLSXreader, CalamineWorkbook
+
+
+def write_workbook(path: str, days: int):
+    """ Writes an export with the title rows, a metadata block, an empty row and the data block"""
+    dates = pd.date_range("2024-01-01", periods=days * 24 * 60, freq="min")
+    values = np.round(np.random.default_rng(0).random((len(dates), len(REQUIRED_COLUMNS))) * 4, 3)
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    for title in ["Historian export", "PLANT01", None, None, None]:
+        sheet.append([title])
+    sheet.append(["Tag", "Description", "Unit"])
+    for tag in REQUIRED_COLUMNS:
+        sheet.append([tag, "synthetic", "-"])
+    sheet.append([])
+    sheet.append([None, None] + REQUIRED_COLUMNS)
+    for i, date in enumerate(dates.to_pydatetime()):
+        sheet.append([None, date] + values[i].tolist())
+    workbook.save(path)
+
+
+def legacy_read(path: str) -> pd.DataFrame:
+    testDf = pd.read_excel(path, skiprows=range(5), engine='openpyxl')
+    n = testDf[testDf.isnull().all(axis=1)].index[0]
+    df = pd.read_excel(path, skiprows=range(7 + n), engine='openpyxl')
+    df = df.rename(columns={"Unnamed: 1": "DateTime"})
+    return df.loc[:, ~df.columns.str.contains('^Unnamed')]
+
+
+def timed(func, path):
+    start = time.perf_counter()
+    out = func(path)
+    return out, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "export.xlsx")
+        write_workbook(path, days)
+        print(f"{days} days, {os.path.getsize(path) / 2 ** 20:,.1f} MiB, "
+              f"backend: {'calamine' if CalamineWorkbook is not None else 'openpyxl read-only'}")
+        old, oldTime = timed(legacy_read, path)
+        new, newTime = timed(XLSXreader, path)
+        pd.testing.assert_frame_equal(old, new, check_dtype=False)
+        print(f"read_excel twice : {oldTime:7.2f} s")
+        print(f"XLSXreader       : {newTime:7.2f} s ({oldTime / newTime:.1f}x)")
@@ -0,0 +1,119 @@
+""" Synthetic historian data for the benchmarks: the four checkData tags with a daily production rhythm, weekends,
+noise and clog episodes, written as the long format CSV or the Excel export the data loader reads.
+
+python -m Benchmarks.historian export.csv --days 30 --anomaly-rate 0.01
+"""
+import numpy as np
+import pandas as pd
+from Model.data_loader import REQUIRED_COLUMNS, CSV_HEADER, DUTCH_MONTHS
+
+MONTH_NAMES = np.array(list(DUTCH_MONTHS))  # The loader's month table in calendar order, index + 1 is the month
+BL02, BL03, FI02, OV01 = REQUIRED_COLUMNS
+
+
+def generate(days: int, extra_tags: int = 0, anomaly_rate: float = 0.01, start: str = "2024-01-01",
+             freq: str = "min", seed: int = 0):
+    """
+    Generates a wide frame of historian values
+
+    Normal operation has the two blower pressures slightly below zero, a filling and emptying weight between
+    0 and 15 kg and a humidity between 2 and 4 %, with pressures closer to zero outside production hours and in
+    weekends. In a clog, lasting 10 to 90 minutes, the pressures hammer between 0 and -0.3 bar every other
+    minute and the weight stalls.
+
+    Args:
+        days (int): Length of the export
+        extra_tags (int): Tags besides the four checkData tags, e.g. to test the pivot on wide exports
+        anomaly_rate (float): Fraction of the rows inside a clog episode
+        start (str): First timestamp
+        freq (str): Sample interval
+        seed (int): Seed of the random generator, the same arguments always give the same data
+
+    Returns:
+        frame (pd.DataFrame): Date and one column per tag
+        episodes (pd.DataFrame): start and end of every injected clog
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start, pd.Timestamp(start) + pd.Timedelta(days=days), freq=freq, inclusive="left")
+    n = len(dates)
+    hours = dates.hour.to_numpy() + dates.minute.to_numpy() / 60
+    production = ((hours >= 6) & (hours < 22) & (dates.dayofweek < 5)).astype(float)  # Two shifts on weekdays
+    drift = np.cumsum(rng.normal(0, 2e-4, n))
+    drift -= np.convolve(drift, np.ones(1440) / 1440, mode="same")  # Slow wander around the mean
+
+    frame = pd.DataFrame({"Date": dates})
+    frame[BL02] = -0.02 - 0.04 * production + drift + rng.normal(0, 0.004, n)
+    frame[BL03] = -0.015 - 0.035 * production + 0.8 * drift + rng.normal(0, 0.004, n)
+    frame[FI02] = 15 * ((np.arange(n) % 37) / 37) * production + rng.normal(0, 0.1, n)  # Filling cycles
+    frame[OV01] = 3 + 0.3 * np.sin(2 * np.pi * hours / 24) + rng.normal(0, 0.05, n)
+
+    # Clog episodes: the pressures hammer between 0 and -0.3 bar and the weight stalls
+    starts, ends = [], []
+    n_anomalous = int(n * anomaly_rate)
+    while n_anomalous > 0 and n > 100:
+        length = min(int(rng.integers(10, 90)), n_anomalous)
+        first = int(rng.integers(0, n - length))
+        rows = slice(first, first + length - 1)
+        pulse = np.arange(length) % 2 == 1
+        frame.loc[rows, BL02] = np.where(pulse, rng.normal(-0.3, 0.01, length), rng.normal(0, 0.003, length))
+        frame.loc[rows, BL03] = np.where(pulse, rng.normal(-0.27, 0.01, length), rng.normal(0, 0.003, length))
+        frame.loc[rows, FI02] = frame.at[first, FI02]
+        starts.append(dates[first])
+        ends.append(dates[first + length - 1])
+        n_anomalous -= length
+
+    for i in range(extra_tags):
+        frame[f"EXTRA{i:03d} -  (-)"] = rng.random(n) * 4
+    frame[REQUIRED_COLUMNS[:2]] = frame[REQUIRED_COLUMNS[:2]].clip(-0.5, 0.005)
+    frame[FI02] = frame[FI02].clip(0, 15)
+    frame = frame.round(4)
+    episodes = pd.DataFrame({"start": starts, "end": ends}).sort_values("start", ignore_index=True)
+    return frame, episodes
+
+
+def write_csv(path: str, frame: pd.DataFrame):
+    """ Writes the frame as the long format export: a preamble, the header and one row per tag and timestamp,
+    with Dutch month names and decimal commas"""
+    dates = frame["Date"]
+    stamps = dates.dt.strftime("%d ") + MONTH_NAMES[dates.dt.month - 1] + dates.dt.strftime(" %Y %H:%M:%S")
+    with open(path, "w") as f:
+        f.write("Historian export\nServer,PLANT01\n\n")
+        f.write(CSV_HEADER + "\n")
+        for tag in frame.columns.drop("Date"):
+            values = np.char.replace(frame[tag].to_numpy().astype(str), ".", ",")
+            pd.DataFrame({"DateTime": stamps, "TagName": tag, "Value": values}).to_csv(f, header=False, index=False)
+
+
+def write_xlsx(path: str, frame: pd.DataFrame):
+    """ Writes the frame as the Excel export: title rows, a tag metadata block, an empty row and the data block"""
+    import openpyxl
+    tags = list(frame.columns.drop("Date"))
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    for title in ["Historian export", "PLANT01", None, None, None]:
+        sheet.append([title])
+    sheet.append(["Tag", "Description", "Unit"])
+    for tag in tags:
+        sheet.append([tag, "synthetic", "-"])
+    sheet.append([])
+    sheet.append([None, None] + tags)
+    values = frame[tags].to_numpy().tolist()
+    for date, row in zip(frame["Date"].tolist(), values):
+        sheet.append([None, date] + row)
+    workbook.save(path)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Write a synthetic historian export")
+    parser.add_argument("path", help="Output file, .csv or .xlsx")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--extra-tags", type=int, default=0)
+    parser.add_argument("--anomaly-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    frame, episodes = generate(args.days, args.extra_tags, args.anomaly_rate, seed=args.seed)
+    (write_xlsx if args.path.endswith(".xlsx") else write_csv)(args.path, frame)
+    print(f"{len(frame)} rows, {len(frame.columns) - 1} tags, {len(episodes)} clog episodes written to {args.path}")
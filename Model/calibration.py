@@ -0,0 +1,212 @@
+""" Calibration of the anomaly cutoffs from the reconstruction errors of normal operation.
+
+The errors of every row are streamed through a QuantileSketch, so any amount of data is calibrated in one pass
+with a fixed amount of memory, and sketches of different files or processes are merged by adding their counts.
+The cutoffs are stored next to the model in Source_file (cutoffs_*.json) and read by results.anomaly_flag.
+
+Run from the repository root:  python -m Model.calibration normal_operation/*.csv --thresholds -0.25
+"""
+import json
+import logging
+import math
+import os
+import numpy as np
+from Model.model_registry import registry, cutoffs_path, THRESHOLDS
+
+ERROR_QUANTILE = 0.99  # Rows with an error above this quantile of normal operation are flagged
+AE_QUANTILE = 0.99  # Quantile of the rolling average error (AE) of normal operation used as AE cutoff
+DC_CUTOFF = 0.6  # Part of the last ROLLING_WINDOW rows that has to be flagged, not taken from the data
+RELATIVE_ACCURACY = 0.005
+
+logger = logging.getLogger(__name__)
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with a relative error guarantee (the DDSketch bucketing)
+
+    Every value v > 0 is counted in bucket ceil(log(v) / log(gamma)) with gamma = (1 + a) / (1 - a), so each
+    returned quantile is within a relative error a of a value of that rank. Sketches with the same accuracy
+    merge by adding their bucket counts. Values of 0 or less are counted separately.
+
+    Args:
+        relative_accuracy (float): Relative error a of the quantiles
+    """
+
+    def __init__(self, relative_accuracy: float = RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.buckets = {}  # bucket index -> count
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, values):
+        """ Adds an array of values, NaN values are skipped"""
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        positive = values[values > 0]
+        indices, counts = np.unique(np.ceil(np.log(positive) / math.log(self.gamma)).astype(np.int64),
+                                    return_counts=True)
+        for index, count in zip(indices.tolist(), counts.tolist()):
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zero_count += len(values) - len(positive)
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def merge(self, other: "QuantileSketch"):
+        """ Adds the counts of another sketch with the same accuracy"""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Only sketches with the same relative accuracy can be merged")
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            raise ValueError("The sketch is empty")
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return max(self.min, 0.0) if self.zero_count < self.count else self.min
+        seen = self.zero_count
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                value = 2 * self.gamma ** index / (self.gamma + 1)  # Middle of the bucket in relative terms
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {"relative_accuracy": self.relative_accuracy, "zero_count": self.zero_count, "count": self.count,
+                "min": self.min, "max": self.max, "buckets": {str(index): count for index, count in self.buckets.items()}}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "QuantileSketch":
+        sketch = cls(data["relative_accuracy"])
+        sketch.buckets = {int(index): count for index, count in data["buckets"].items()}
+        sketch.zero_count, sketch.count = data["zero_count"], data["count"]
+        sketch.min, sketch.max = data["min"], data["max"]
+        return sketch
+
+
+def _sketch_file(file_path: str, thresholds, batch_size: int):
+    """ The error and AE sketches of one file per threshold, the file is loaded and cleaned once"""
+    import pandas as pd
+    from Model.data_loader import data_loader
+    from Model.data_preprocessor import prepare_data, scaled_predict, timelagged
+    from Model.results import predict_results, ROLLING_WINDOW
+
+    prediction_data = prepare_data(data_loader(file_path))
+    sketches = {}
+    for pressure_threshold in thresholds:
+        scaled = scaled_predict(prediction_data, pressure_threshold)
+        n_past = registry.get_model(pressure_threshold).input_shape[1]
+        errors = predict_results(prediction_data, timelagged(scaled, n_past), pressure_threshold,
+                                 batch_size=batch_size)['Error'].to_numpy()
+        ae = pd.Series(errors).rolling(ROLLING_WINDOW, min_periods=1).sum() / ROLLING_WINDOW  # As in anomaly_flag
+        error_sketch, ae_sketch = QuantileSketch(), QuantileSketch()
+        error_sketch.add(errors)
+        ae_sketch.add(ae.to_numpy())
+        sketches[pressure_threshold] = (error_sketch, ae_sketch)
+    return sketches
+
+
+def load_calibration(pressure_threshold: float, version: str = None):
+    """ The stored cutoffs and sketches of a threshold, None when it was never calibrated"""
+    path = cutoffs_path(pressure_threshold, version)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def calibrate(file_paths, thresholds=THRESHOLDS, error_quantile: float = ERROR_QUANTILE,
+              ae_quantile: float = AE_QUANTILE, dc_cutoff: float = DC_CUTOFF, update: bool = False,
+              workers: int = 1, batch_size: int = 4096, version: str = None):
+    """
+    Derives the error, DC and AE cutoffs of each threshold from exports of normal operation
+
+    Args:
+        file_paths (list): CSV or Excel exports of normal operation
+        thresholds (list): Pressure thresholds of the models to calibrate
+        error_quantile (float): Quantile of the row errors used as error cutoff
+        ae_quantile (float): Quantile of the rolling average error used as AE cutoff
+        dc_cutoff (float): DC cutoff, stored as it is
+        update (bool): Merge the data into the stored sketches instead of starting over, e.g. to add a month
+        workers (int): Processes the files are spread over, their sketches are merged
+        batch_size (int): Windows per inference batch
+        version (str): Model version
+
+    Returns:
+        cutoffs (dict): Threshold -> (error cutoff, DC cutoff, AE cutoff), as stored in Source_file
+    """
+    file_paths = list(file_paths)
+    thresholds = list(thresholds)
+    merged = {}
+    for pressure_threshold in thresholds:
+        stored = load_calibration(pressure_threshold, version) if update else None
+        if stored is not None:
+            merged[pressure_threshold] = (QuantileSketch.from_dict(stored["error_sketch"]),
+                                          QuantileSketch.from_dict(stored["ae_sketch"]))
+        else:
+            merged[pressure_threshold] = (QuantileSketch(), QuantileSketch())
+
+    def merge_all(per_file):
+        for sketches in per_file:
+            for pressure_threshold, (error_sketch, ae_sketch) in sketches.items():
+                merged[pressure_threshold][0].merge(error_sketch)
+                merged[pressure_threshold][1].merge(ae_sketch)
+
+    if workers <= 1:
+        merge_all(_sketch_file(file_path, thresholds, batch_size) for file_path in file_paths)
+    else:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        context = multiprocessing.get_context("spawn")  # TensorFlow is not safe to fork once it is initialized
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            merge_all(pool.map(_sketch_file, file_paths, [thresholds] * len(file_paths),
+                               [batch_size] * len(file_paths)))
+
+    cutoffs = {}
+    for pressure_threshold, (error_sketch, ae_sketch) in merged.items():
+        cutoffs[pressure_threshold] = (error_sketch.quantile(error_quantile), dc_cutoff,
+                                       ae_sketch.quantile(ae_quantile))
+        calibration = {"pressure_threshold": pressure_threshold,
+                       "error_cutoff": cutoffs[pressure_threshold][0], "dc_cutoff": dc_cutoff,
+                       "ae_cutoff": cutoffs[pressure_threshold][2],
+                       "error_quantile": error_quantile, "ae_quantile": ae_quantile, "rows": error_sketch.count,
+                       "error_sketch": error_sketch.to_dict(), "ae_sketch": ae_sketch.to_dict()}
+        path = cutoffs_path(pressure_threshold, version)
+        with open(path + ".tmp", "w") as f:
+            json.dump(calibration, f)
+        os.replace(path + ".tmp", path)
+        registry.invalidate(pressure_threshold, version)
+        logger.info("Calibrated %s on %d rows: error cutoff %.4f, DC cutoff %s, AE cutoff %.4f", pressure_threshold,
+                    error_sketch.count, cutoffs[pressure_threshold][0], dc_cutoff, cutoffs[pressure_threshold][2])
+    return cutoffs
+
+
+if __name__ == "__main__":
+    import argparse
+    from Model.instrumentation import configure_logging
+
+    parser = argparse.ArgumentParser(description="Calibrate the anomaly cutoffs on exports of normal operation")
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=list(THRESHOLDS))
+    parser.add_argument("--error-quantile", type=float, default=ERROR_QUANTILE)
+    parser.add_argument("--ae-quantile", type=float, default=AE_QUANTILE)
+    parser.add_argument("--dc-cutoff", type=float, default=DC_CUTOFF)
+    parser.add_argument("--update", action="store_true", help="Merge into the stored calibration")
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    configure_logging()
+    calibrate(args.files, args.thresholds, args.error_quantile, args.ae_quantile, args.dc_cutoff, args.update,
+              args.workers)
@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import os
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:  # The cache is optional, without pyarrow every load parses the file again
+    feather = None
+
+CACHE_DIR = os.environ.get("ADS_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "anomaly_detection_system"))
+CACHE_MAX_BYTES = int(os.environ.get("ADS_CACHE_MAX_BYTES", 2 * 1024 ** 3))  # Total size kept on disk
+HASH_BLOCK_SIZE = 4 * 1024 ** 2
+
+logger = logging.getLogger(__name__)
+
+_hashes = {}  # (path, size, mtime) -> content hash, so repeated loads in one session skip re-hashing
+
+
+def fileHash(file_path: str) -> str:
+    """ Content hash of a file, read in blocks so large exports are never fully in memory"""
+    stat = os.stat(file_path)
+    statKey = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if statKey not in _hashes:
+        digest = hashlib.blake2b(digest_size=20)
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+        _hashes[statKey] = digest.hexdigest()
+    return _hashes[statKey]
+
+
+def cachePath(file_path: str, version: str) -> str:
+    return os.path.join(CACHE_DIR, f"{fileHash(file_path)}_v{version}.feather")
+
+
+def load(file_path: str, version: str):
+    """ Returns the cached wide DataFrame of a file, or None when it is not cached yet"""
+    if feather is None:
+        return None
+    path = cachePath(file_path, version)
+    if not os.path.isfile(path):
+        return None
+    try:
+        table = feather.read_table(path, memory_map=True)
+        df = table.to_pandas()
+    except (OSError, pa.ArrowException) as e:
+        logger.warning("Ignoring unreadable cache entry %s: %s", path, e)
+        return None
+    os.utime(path)  # Marks the entry as recently used for the eviction
+    logger.debug("Loaded from cache: %s", path)
+    return df
+
+
+def store(file_path: str, version: str, df: pd.DataFrame):
+    """ Writes the wide DataFrame of a file to the cache and evicts the oldest entries above CACHE_MAX_BYTES"""
+    if feather is None:
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = cachePath(file_path, version)
+    tmpPath = f"{path}.{os.getpid()}.tmp"
+    try:
+        # Uncompressed so the file can be memory-mapped on the next load
+        feather.write_feather(df.reset_index(drop=True), tmpPath, compression="uncompressed")
+        os.replace(tmpPath, path)
+    except (OSError, pa.ArrowException) as e:
+        logger.warning("Could not write cache entry %s: %s", path, e)
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        return
+    evict()
+
+
+def evict(max_bytes: int = None):
+    """ Removes the least recently used cache entries until the cache fits in max_bytes"""
+    if max_bytes is None:
+        max_bytes = CACHE_MAX_BYTES
+    if not os.path.isdir(CACHE_DIR):
+        return
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith(".feather"):
+            try:
+                stat = os.stat(os.path.join(CACHE_DIR, name))
+            except FileNotFoundError:  # Removed by another process in the meantime
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(CACHE_DIR, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def clear():
+    """ Removes every cache entry"""
+    evict(0)
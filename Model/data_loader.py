@@ -1,78 +1,265 @@
+import logging
 import pandas as pd
+import numpy as np
 import os
+import datetime
+import openpyxl
+try:
+    from python_calamine import CalamineWorkbook  # Optional Rust backend, much faster than openpyxl
+except ImportError:
+    CalamineWorkbook = None
 from UI_files.resource_path import resource_path
+from Model import data_cache
+from Model.instrumentation import stage
+
+REQUIRED_COLUMNS = [
+    '18BL02PT\\PV -  (Bar)', '18BL03PT\\PV -  (Bar)',
+    '18FI02LT01 -  (kg)', '18OV01HM01_filtered -  (%)'
+]
+LOADER_VERSION = "3"  # Bump when the output of data_loader changes, so cached datasets are rebuilt
+CSV_HEADER = "DateTime,TagName,Value"
+CSV_CHUNKSIZE = 500_000  # Rows parsed per chunk, bounds the peak memory of the CSV reader
+XLSX_SKIPROWS = 6  # Title rows and the header of the metadata block above the data block
+
+logger = logging.getLogger(__name__)
 
-def CSVstartChecker(file_path: str):
-    with open(file_path) as f:
-        lines = f.readlines()
-        for i in range(len(lines)):
-            if lines[i].startswith("DateTime,TagName,Value"):
-                return i
 
-def CSVsplitterMerger(df: pd.DataFrame):
-    tags = pd.unique(df["TagName"])
+def CSVreader(file_path: str, tags=None, chunksize: int = CSV_CHUNKSIZE):
+    """ Reads the long format historian export in one streaming pass, keeping only the rows of the given tags"""
+    if tags is None:
+        tags = REQUIRED_COLUMNS
     frames = []
-    for tag in tags:
-        frame = df.loc[df["TagName"] == tag]
-        frame = frame.rename(columns={"Value": tag})
-        frame = frame.drop(columns=["TagName"])
-        frame[tag] = frame[tag].replace(to_replace={",": "."}, regex=True)
-        frame[tag] = pd.to_numeric(frame[tag])
-        frames.append(frame)
-
-    df_final = frames[0]
-    if len(frames) > 1:
-        for i in range(1, len(frames)):
-            df_final = df_final.merge(frames[i], on="DateTime")
+    with open(file_path) as f:
+        line = f.readline()
+        while line and not line.startswith(CSV_HEADER):
+            line = f.readline()
+        if not line:
+            raise ValueError(f"No '{CSV_HEADER}' header found in the CSV file.")
+
+        # The reader continues from the line after the header, so the file is only read once
+        reader = pd.read_csv(f, header=None, names=line.strip().split(","), usecols=["DateTime", "TagName", "Value"],
+                             dtype={"DateTime": str, "TagName": str, "Value": str}, chunksize=chunksize)
+        for chunk in reader:
+            chunk = chunk.loc[chunk["TagName"].isin(tags)]
+            frames.append(chunk.assign(Value=pd.to_numeric(chunk["Value"].str.replace(",", ".", regex=False))))
+
+    if not frames:
+        return pd.DataFrame(columns=["DateTime", "TagName", "Value"])
+    return pd.concat(frames, ignore_index=True)
+
+def CSVsplitterMerger(df: pd.DataFrame, duplicates: str = "last", missing: str = "drop"):
+    """ Reshapes the long format frame into one column per tag with a single pivot
+
+    duplicates decides which value is kept when a tag is reported more than once for the same
+    timestamp ("first", "last" or "mean"). missing decides what happens to timestamps where not
+    every tag has a value: "drop" removes them, "keep" leaves them as NaN for the forward fill
+    in read_initial_data.
+    """
+    if duplicates not in ("first", "last", "mean"):
+        raise ValueError(f"Unknown duplicates policy: {duplicates}")
+    if missing not in ("drop", "keep"):
+        raise ValueError(f"Unknown missing policy: {missing}")
+
+    values = df["Value"]
+    if values.dtype == object:  # Frames that did not come through CSVreader still hold decimal-comma strings
+        values = pd.to_numeric(values.str.replace(",", ".", regex=False))
+    values = values.to_numpy(dtype=float)
+
+    # Timestamps and tags are numbered in order of appearance, so the output keeps the file order
+    rowCodes, stamps = pd.factorize(df["DateTime"])
+    colCodes, tags = pd.factorize(df["TagName"])
+    keys = rowCodes.astype(np.int64) * len(tags) + colCodes
+    size = len(stamps) * len(tags)
+
+    if duplicates == "mean":
+        sums = np.bincount(keys, weights=values, minlength=size)
+        counts = np.bincount(keys, minlength=size)
+        with np.errstate(invalid="ignore"):
+            wide = sums / counts
+        nDuplicates = int((counts > 1).sum())
+    else:
+        isDuplicate = pd.Series(keys).duplicated(keep=duplicates).to_numpy()
+        wide = np.full(size, np.nan)
+        wide[keys[~isDuplicate]] = values[~isDuplicate]
+        nDuplicates = int(isDuplicate.sum())
+    if nDuplicates:
+        logger.warning("%d duplicate timestamp/tag values resolved with policy '%s'", nDuplicates, duplicates)
+
+    df_final = pd.DataFrame(wide.reshape(len(stamps), len(tags)), columns=list(tags))
+    df_final.insert(0, "DateTime", stamps)
+
+    incomplete = df_final[list(tags)].isna().any(axis=1)
+    if missing == "drop" and incomplete.any():
+        logger.warning("%d timestamps without a value for every tag dropped", int(incomplete.sum()))
+        df_final = df_final.loc[~incomplete].reset_index(drop=True)
     return df_final
 
-def dateTimeFix(df: pd.DataFrame):
+def _XLSXrows(file_path: str):
+    """ Yields the rows of the first sheet as tuples of cell values, with calamine when it is installed"""
+    if CalamineWorkbook is not None:
+        sheet = CalamineWorkbook.from_path(file_path).get_sheet_by_index(0)
+        yield from sheet.iter_rows()
+    else:
+        workbook = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            yield from workbook.worksheets[0].iter_rows(values_only=True)
+        finally:
+            workbook.close()
+
+
+def _isEmpty(value) -> bool:
+    return value is None or value == ""
+
+
+def XLSXreader(file_path: str) -> pd.DataFrame:
+    """ Reads the Excel export in a single traversal of the sheet
+
+    The export starts with a metadata block that ends at the first completely empty row. The row
+    after it holds the tag names, with the timestamps in the second (unnamed) column, and the data
+    follows until the end of the sheet.
+    """
+    rows = _XLSXrows(file_path)
+    header = None
+    for i, row in enumerate(rows):
+        if i >= XLSX_SKIPROWS and all(_isEmpty(value) for value in row):
+            header = next(rows, None)
+            break
+    if header is None:
+        raise ValueError("No data block found in the Excel file.")
+
+    header = list(header)
+    if _isEmpty(header[1]):
+        header[1] = "DateTime"
+    keep = [i for i, name in enumerate(header) if not _isEmpty(name)]
+    data = [[row[i] if i < len(row) else None for i in keep] for row in rows]
+
+    # Trailing empty rows are not part of the data block
+    while data and all(_isEmpty(value) for value in data[-1]):
+        data.pop()
+    df = pd.DataFrame(data, columns=[str(header[i]) for i in keep])
+    df = df.replace("", np.nan).infer_objects()
+
+    # calamine returns midnight timestamps as dates, which keeps the column from being inferred as datetimes
+    stamps = df["DateTime"].dropna()
+    if df["DateTime"].dtype == object and len(stamps) and isinstance(stamps.iloc[0], datetime.date):
+        df["DateTime"] = pd.to_datetime(df["DateTime"], errors="coerce")
+    return df
+
+
+DUTCH_MONTHS = {
+    "jan": "01", "feb": "02", "mrt": "03", "apr": "04", "mei": "05", "jun": "06",
+    "jul": "07", "aug": "08", "sep": "09", "okt": "10", "nov": "11", "dec": "12"
+}
+
+
+def _parseFixedWidth(text: np.ndarray) -> np.ndarray:
+    """ Parses "dd mmm yyyy HH:MM:SS" strings by rearranging their bytes into ISO order, NaT where the layout differs"""
+    raw = np.char.encode(text.astype("U20"), "ascii", errors="replace").astype("S20")
+    chars = raw.view(np.uint8).reshape(-1, 20)
+
+    keys = np.array(list(DUTCH_MONTHS), dtype="S3")  # Index + 1 is the month number
+    monthText = np.ascontiguousarray(chars[:, 3:6]).view("S3").ravel()
+    order = np.argsort(keys)
+    pos = np.searchsorted(keys[order], monthText).clip(0, len(keys) - 1)
+    month = order[pos] + 1
+    valid = (keys[order][pos] == monthText) & (chars[:, 2] == 32) & (chars[:, 6] == 32) & (chars[:, 11] == 32)
+
+    iso = np.empty((len(chars), 19), dtype=np.uint8)
+    iso[:, 0:4] = chars[:, 7:11]
+    iso[:, 4] = iso[:, 7] = ord("-")
+    iso[:, 5] = ord("0") + month // 10
+    iso[:, 6] = ord("0") + month % 10
+    iso[:, 8:10] = chars[:, 0:2]
+    iso[:, 10] = ord(" ")
+    iso[:, 11:19] = chars[:, 12:20]
+
+    parsed = pd.to_datetime(iso.view("S19").ravel().astype("U19"), format="%Y-%m-%d %H:%M:%S", errors="coerce")
+    parsed = parsed.to_numpy()
+    parsed[~valid] = np.datetime64("NaT")
+    return parsed
+
+
+def parseDutchDates(dates: pd.Series) -> pd.Series:
+    """ Parses the historian's Dutch timestamps ("05 mrt 2024 13:07:00") into datetimes
+
+    Every distinct string is parsed only once. Strings in the standard 20 character layout are
+    rearranged into ISO order as a byte array so pandas can use its fixed-format parser instead
+    of guessing the layout per element. Other strings (single digit days, fractional seconds,
+    non-Dutch layouts) fall back to a slower day-first parse, anything still unreadable is NaT.
+    """
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+
+    codes, uniques = pd.factorize(dates)
+    text = pd.Series(uniques, dtype=str).str.strip()
+    parsed = np.full(len(text), np.datetime64("NaT"), dtype="datetime64[ns]")
+
+    fixed = (text.str.len() == 20).to_numpy()
+    if fixed.any():
+        parsed[fixed] = _parseFixedWidth(text[fixed].to_numpy(dtype=str))
+
+    other = np.isnat(parsed)
+    if other.any():
+        rest = text[other].reset_index(drop=True)
+        parts = rest.str.extract(r"^(\d{1,2}) ([a-z]{3}) (\d{4}) (\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?)$")
+        iso = parts[2] + "-" + parts[1].map(DUTCH_MONTHS) + "-" + parts[0].str.zfill(2) + " " + parts[3].str.zfill(5)
+        restParsed = pd.to_datetime(iso, format="ISO8601", errors="coerce")
+        notDutch = restParsed.isna()
+        if notDutch.any():
+            restParsed[notDutch] = pd.to_datetime(rest[notDutch], dayfirst=True, errors="coerce", format="mixed")
+        parsed[other] = restParsed.to_numpy()
+
+    result = parsed[codes]
+    result[codes == -1] = np.datetime64("NaT")
+    return pd.Series(result, index=dates.index, name=dates.name)
+
+
+def dateTimeFix(df: pd.DataFrame, errors: str = "drop"):
+    """ Renames the timestamp column to Date and converts it to datetimes
+
+    Rows whose timestamp cannot be parsed are reported; with errors="drop" they are removed,
+    with errors="raise" a ValueError is raised before any further processing.
+    """
     df = df.rename(columns={"DateTime": "Date"})
-    replDict = {
-        " jan ": "-01-", " feb ": "-02-", " mrt ": "-03-", " apr ": "-04-",
-        " mei ": "-05-", " jun ": "-06-", " jul ": "-07-", " aug ": "-08-",
-        " sep ": "-09-", " okt ": "-10-", " nov ": "-11-", " dec ": "-12-"
-    }
-    df["Date"] = df["Date"].replace(to_replace=replDict, regex=True)
-    df["Date"] = pd.to_datetime(df["Date"], dayfirst=True)
+    df["Date"] = parseDutchDates(df["Date"])
+
+    unparsed = df["Date"].isna()
+    if unparsed.any():
+        examples = ", ".join(df.index[unparsed][:5].astype(str))
+        message = f"{int(unparsed.sum())} rows with an unreadable timestamp (first rows: {examples})"
+        if errors == "raise":
+            raise ValueError(message)
+        logger.warning("%s dropped", message)
+        df = df.loc[~unparsed].reset_index(drop=True)
     return df
 
 def checkData(df: pd.DataFrame):
-    reqColumns = [
-        '18BL02PT\\PV -  (Bar)', '18BL03PT\\PV -  (Bar)',
-        '18FI02LT01 -  (kg)', '18OV01HM01_filtered -  (%)'
-    ]
-    for col in reqColumns:
+    for col in REQUIRED_COLUMNS:
         if col not in df.columns:
             return False
     return True
 
-def data_loader(file_path: str):
+def data_loader(file_path: str, use_cache: bool = True):
+    """ Loads a CSV or Excel export as a wide frame with Date and a column per tag, from the cache when it was
+    loaded before. The load is recorded as the data_loader stage, with the file size and whether the cache hit."""
     file_path = resource_path(file_path)
-    print(file_path)
+    with stage("data_loader", file=file_path, bytes=os.path.getsize(file_path)) as record:
+        df = data_cache.load(file_path, LOADER_VERSION) if use_cache else None
+        record["cache_hit"] = df is not None
+        if df is None:
+            df = _parse(file_path)
+            if use_cache:
+                data_cache.store(file_path, LOADER_VERSION, df)
+        record["rows"] = len(df)
+    return df
+
+
+def _parse(file_path: str) -> pd.DataFrame:
     if file_path.endswith('.csv'):
-        startLine = CSVstartChecker(file_path)
-        raw = pd.read_csv(file_path, skiprows=startLine)
+        raw = CSVreader(file_path)
         df = CSVsplitterMerger(raw)
     elif file_path.endswith('.xlsx'):
-        print('gets to xlsx')
-        try:
-            testDf = pd.read_excel(file_path, skiprows=range(5), engine='openpyxl')
-            print('Initial DataFrame loaded:')
-            print(testDf.head())
-
-            emptyRow = testDf.isnull().all(axis=1)
-            n = testDf[emptyRow].index[0]
-            print(f'First completely empty row index: {n}')
-
-            df = pd.read_excel(file_path, skiprows=range(7 + n), engine='openpyxl')
-            df = df.rename(columns={"Unnamed: 1": "DateTime"})
-            df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
-            print('Processed DataFrame:')
-            print(df.head())
-        except Exception as e:
-            print(f'Error reading Excel file: {e}')
-            raise
+        df = XLSXreader(file_path)
     else:
         raise ValueError("Unsupported file format. Please select a CSV or Excel file.")
 
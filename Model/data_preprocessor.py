@@ -3,22 +3,38 @@ import numpy as np
 from sklearn.preprocessing import MinMaxScaler
 import joblib
 import os
-from UI_files.resource_path import resource_path
-
-def clearWeekends(df: pd.DataFrame) -> pd.DataFrame:
-    """ Clear weekends from the data"""
-    df['Date'] = pd.to_datetime(df['Date'] , dayfirst = True)
-    toDrop = []
-    for ind, row in df.iterrows():
-        date = row["Date"]
-        day = date.weekday()
-        if day == 4 and date.hour > 23:
-            toDrop.append(ind)
-        elif day == 5:
-            toDrop.append(ind)
-        elif day == 6 and date.hour <= 23:
-            toDrop.append(ind)
-    newDf = df.drop(index=toDrop)
+from Model.model_registry import registry, scaler_path
+from Model.instrumentation import stage
+
+# Non-production windows (holidays, planned maintenance) excluded on top of the weekends.
+# Each entry is a (start, end) pair, end exclusive, e.g. ("2024-12-24 18:00", "2024-12-27 06:00").
+NON_PRODUCTION_WINDOWS = []
+
+
+def nonProductionMask(dates: pd.Series, windows=None) -> np.ndarray:
+    """ Boolean mask that is True for every timestamp in a weekend or a non-production window"""
+    if windows is None:
+        windows = NON_PRODUCTION_WINDOWS
+    mask = dates.dt.weekday.to_numpy() >= 5  # Saturday and Sunday
+
+    if windows:
+        bounds = sorted((pd.Timestamp(start), pd.Timestamp(end)) for start, end in windows)
+        starts = np.array([start for start, _ in bounds], dtype='datetime64[ns]')
+        ends = np.maximum.accumulate(np.array([end for _, end in bounds], dtype='datetime64[ns]'))
+        values = dates.to_numpy(dtype='datetime64[ns]')
+        # Latest window starting at or before each timestamp; the running max of the ends covers overlaps
+        pos = np.searchsorted(starts, values, side='right') - 1
+        inWindow = pos >= 0
+        inWindow[inWindow] = values[inWindow] < ends[pos[inWindow]]
+        mask |= inWindow
+    return mask
+
+
+def clearWeekends(df: pd.DataFrame, windows=None) -> pd.DataFrame:
+    """ Clear weekends and the configured non-production windows from the data"""
+    if not pd.api.types.is_datetime64_any_dtype(df['Date']):
+        df = df.assign(Date=pd.to_datetime(df['Date'], dayfirst=True))  # Leaves the caller's frame as it is
+    newDf = df.take(np.flatnonzero(~nonProductionMask(df['Date'], windows)))  # A new frame, not a view of df
     return newDf
 
 def read_initial_data(df: pd.DataFrame):
@@ -28,6 +44,25 @@ def read_initial_data(df: pd.DataFrame):
     df = df[columns_to_select]
     return df
 
+def prepare_data(df: pd.DataFrame, progress=None):
+    """ The preprocessing that does not depend on the threshold: weekends and the initial setup.
+    df is not modified, so the result can be scored or trained on with any number of thresholds.
+    progress, when given, is called with the name of each step before it runs."""
+    if progress is None:
+        progress = lambda stage, fraction=0.0: None
+
+    progress("clear weekends")
+    with stage("clearWeekends") as record:
+        prepared = clearWeekends(df)
+        record["rows"] = len(prepared)
+
+    # Perform Initial Setup
+    progress("prepare")
+    with stage("read_initial_data") as record:
+        prepared = read_initial_data(prepared)
+        record["rows"] = len(prepared)
+    return prepared
+
 def outlier_treatment(df: pd.DataFrame, pressure_threshold: float):
     """ Cuts of unrealistic values from the data"""
     df.loc[df['18BL02PT\PV -  (Bar)'] < pressure_threshold, '18BL02PT\PV -  (Bar)'] = pressure_threshold
@@ -41,38 +76,36 @@ def outlier_treatment(df: pd.DataFrame, pressure_threshold: float):
 def scaled_train(df: pd.DataFrame, pressure_threshold: float):
     scaler = MinMaxScaler()
     scaled_arr = scaler.fit_transform(df)
-    pressure_threshold_str = str(pressure_threshold)[1:].replace('.', '_')
-    scaler_filename = resource_path(rf"Source_file\scaler_{pressure_threshold_str}.save")
+    scaler_filename = scaler_path(pressure_threshold)
     joblib.dump(scaler, scaler_filename)
-    scaled_arr_final = scaled_arr.reshape(scaled_arr.shape[0], 1, scaled_arr.shape[1])
-    return scaled_arr_final
+    registry.invalidate(pressure_threshold)
+    return scaled_arr.astype(np.float32)  # The model runs in float32, this halves the memory of the array
 
 def scaled_predict(df: pd.DataFrame, pressure_threshold : float):
-    """ Scales the data for prediction using the saved scaler file"""
-
-    pressure_threshold_str = str(pressure_threshold)[1:].replace('.', '_')
-    scaler_filename = resource_path(rf"Source_file\scaler_{pressure_threshold_str}.save")
-
-    print('Scaler file name:', scaler_filename)
+    """ Scales the data for prediction using the saved scaler file, raises FileNotFoundError when there is none"""
 
+    scaler_filename = scaler_path(pressure_threshold)
     if not os.path.isfile(scaler_filename):
-        print(f"Scaler file does not exist: {scaler_filename}")
-    else:
-        try:
-            scaler = joblib.load(scaler_filename)
-            print('Scaler loaded')
-            scaled_arr = scaler.transform(df)
-            scaled_arr_final = scaled_arr.reshape(scaled_arr.shape[0], 1, scaled_arr.shape[1])
-            return scaled_arr_final
-        except FileNotFoundError as fnf_error:
-            print(f"File not found error: {fnf_error}")
-        except IOError as io_error:
-            print(f"IO error: {io_error}")
-        except Exception as e:
-            print(f"Failed to load scaler: {e}")
+        raise FileNotFoundError(f"Scaler file does not exist: {scaler_filename}")
+
+    scaler = registry.get_scaler(pressure_threshold)
+    scaled_arr = scaler.transform(df)
+    return scaled_arr.astype(np.float32)
 
 def timelagged(rawdata: np.array, n_past: int):
-    data_X = []
-    for i in range(n_past, len(rawdata)):
-        data_X.append(rawdata[i - n_past:i, 0:rawdata.shape[1]])
-    return np.array(data_X)
+    """ Time lagged windows of shape (rows - n_past, n_past, features) as a read-only strided view on rawdata
+
+    Window i holds rows i to i + n_past - 1. Nothing is copied, so the memory stays that of rawdata
+    whatever n_past is. Use lagged_batches to materialize the windows batch by batch.
+    """
+    if rawdata.ndim == 3:  # (rows, 1, features) arrays from before the singleton axis was dropped
+        rawdata = rawdata.reshape(rawdata.shape[0], rawdata.shape[2])
+    if len(rawdata) <= n_past:
+        return np.empty((0, n_past, rawdata.shape[1]), dtype=rawdata.dtype)
+    windows = np.lib.stride_tricks.sliding_window_view(rawdata, n_past, axis=0)  # (rows - n_past + 1, features, n_past)
+    return windows[:len(rawdata) - n_past].transpose(0, 2, 1)
+
+def lagged_batches(windows: np.array, batch_size: int):
+    """ Yields contiguous copies of consecutive batches of windows, only one batch is in memory at a time"""
+    for start in range(0, len(windows), batch_size):
+        yield np.ascontiguousarray(windows[start:start + batch_size])
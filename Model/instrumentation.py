@@ -0,0 +1,155 @@
+""" Instrumentation of the pipeline stages: wall time, CPU time, peak RSS, row counts and cache hits.
+
+Every stage runs inside stage(), which logs one record through this module's logger when the stage ends, also
+when it raised, and appends it as a JSON line to the metrics file when one is set. configure_logging() sets up
+the log handler, as text or as one JSON object per line, and the metrics file. Both can also be set with the
+ADS_LOG_LEVEL, ADS_LOG_FORMAT and ADS_METRICS_FILE environment variables, which spawned workers inherit.
+
+    with stage("predict_results", threshold=pressure_threshold) as record:
+        error_df = predict_results(...)
+        record["rows"] = len(error_df)
+
+Only the standard library is imported here (psutil when installed), so the UI can import it at startup.
+"""
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows, the peak RSS comes from psutil there
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+LOG_LEVEL = os.environ.get("ADS_LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("ADS_LOG_FORMAT", "text")  # "text" or "json"
+METRICS_FILE = os.environ.get("ADS_METRICS_FILE")  # JSON lines, one record per stage, appended
+
+logger = logging.getLogger(__name__)
+_context = contextvars.ContextVar("instrumentation_context", default={})
+_metrics_lock = threading.Lock()
+
+
+def peak_rss():
+    """ Peak resident memory of the process in bytes, None when it cannot be read"""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024  # kB on Linux
+    if psutil is not None:
+        return getattr(psutil.Process().memory_info(), "peak_wset", None)
+    return None
+
+
+@contextlib.contextmanager
+def labels(**fields):
+    """ Adds the fields, e.g. the file being scored, to the records of every stage run inside the block"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+@contextlib.contextmanager
+def stage(name: str, **fields):
+    """
+    Measures the block as one pipeline stage and emits its record when the block ends
+
+    The record is a dict the block can add to, e.g. rows or cache_hit. The peak RSS is the high-water mark of
+    the process after the stage, so it shows which stage raised it. A stage that raised gets an error field
+    and the exception is passed on.
+
+    Args:
+        name (str): Stage name, e.g. the function it runs
+        fields: Extra fields of the record
+    """
+    record = {"stage": name, **_context.get(), **fields}
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        record["wall"] = round(time.perf_counter() - wall, 6)
+        record["cpu"] = round(time.process_time() - cpu, 6)  # Includes the TensorFlow threads
+        record["peak_rss"] = peak_rss()
+        emit(record)
+
+
+def _summary(record: dict) -> str:
+    """ One line text form of a stage record"""
+    text = f"{record['stage']} {record['wall']:.3f} s (CPU {record['cpu']:.3f} s)"
+    if record.get("rows") is not None:
+        text += f", {record['rows']} rows"
+    if record.get("cache_hit") is not None:
+        text += ", cache hit" if record["cache_hit"] else ", cache miss"
+    if record.get("peak_rss"):
+        text += f", peak RSS {record['peak_rss'] / 2 ** 20:.0f} MB"
+    extra = {key: value for key, value in record.items()
+             if key not in ("stage", "wall", "cpu", "rows", "cache_hit", "peak_rss")}
+    if extra:
+        text += " [" + ", ".join(f"{key}={value}" for key, value in extra.items()) + "]"
+    return text
+
+
+def emit(record: dict):
+    """ Logs a stage record and appends it to the metrics file"""
+    logger.log(logging.WARNING if "error" in record else logging.INFO, "%s", _summary(record),
+               extra={"metrics": record})
+    if METRICS_FILE:
+        line = json.dumps({"time": datetime.now().isoformat(timespec="milliseconds"), "pid": os.getpid(), **record},
+                          default=str)
+        with _metrics_lock, open(METRICS_FILE, "a") as f:
+            f.write(line + "\n")
+
+
+class StructuredFormatter(logging.Formatter):
+    """ Formats every log record as one JSON object, with the fields of a stage record at the top level"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+                 "level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        entry.update(getattr(record, "metrics", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level: str = None, log_format: str = None, metrics_file: str = None):
+    """
+    Sends the log records of the application to stderr, the settings are passed on to worker processes
+
+    Args:
+        level (str): Lowest level logged, ADS_LOG_LEVEL when None
+        log_format (str): "text" or "json", ADS_LOG_FORMAT when None
+        metrics_file (str): File the stage records are appended to as JSON lines, ADS_METRICS_FILE when None
+    """
+    global LOG_LEVEL, LOG_FORMAT, METRICS_FILE
+    LOG_LEVEL, LOG_FORMAT = level or LOG_LEVEL, log_format or LOG_FORMAT
+    METRICS_FILE = metrics_file or METRICS_FILE
+    handler = logging.StreamHandler()
+    if LOG_FORMAT == "json":
+        handler.setFormatter(StructuredFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logging.basicConfig(level=LOG_LEVEL.upper(), handlers=[handler], force=True)
+
+    os.environ.update(ADS_LOG_LEVEL=LOG_LEVEL, ADS_LOG_FORMAT=LOG_FORMAT)  # Read by configure_worker()
+    if METRICS_FILE:
+        os.environ["ADS_METRICS_FILE"] = METRICS_FILE
+
+
+def configure_worker():
+    """ Sets up logging in a spawned worker process like configure_logging() did in its parent"""
+    if "ADS_LOG_LEVEL" in os.environ:
+        configure_logging()
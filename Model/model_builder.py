@@ -1,11 +1,99 @@
+import logging
+import os
+import time
 import tensorflow as tf
 import keras
 from keras.layers import Input, Dropout, Dense, LSTM, TimeDistributed, RepeatVector
 from keras.models import Model
 from keras import regularizers
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
-from UI_files.resource_path import resource_path
+from Model.model_registry import registry, model_path, threshold_suffix
+
+EPOCHS = 100  # Parameters can be finetuned
+BATCH_SIZE = 128
+LEARNING_RATE = 0.001
+PATIENCE = 10  # Epochs without a lower val_loss before training stops
+VALIDATION_FRACTION = 0.05  # Last part of the time span used for validation
+SHUFFLE_BUFFER = 100_000  # Window starts shuffled at a time
+N_PAST = 2  # Window length of newly trained models, scoring takes it from the loaded model
+
+logger = logging.getLogger(__name__)
+
+
+class EpochTimer(keras.callbacks.Callback):
+    """ Records the wall time of every epoch, it is added to the history as 'epoch_seconds'"""
+
+    def on_train_begin(self, logs=None):
+        self.seconds = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.seconds.append(time.perf_counter() - self._start)
+
+
+def time_split(dates, n_past: int, n_windows: int, validation_fraction: float = VALIDATION_FRACTION,
+               validation_start=None):
+    """
+    Splits the windows into a training and a validation set by time
+
+    The validation set is the last validation_fraction of the time span (not of the rows, so gaps such
+    as weekends do not shift it), or everything from validation_start on. Windows that reach over the
+    boundary are left out of both sets, so no validation row is ever seen during training.
+
+    Args:
+        dates (pd.DatetimeIndex): Timestamp of every row, None to split by rows
+        n_past (int): Window length
+        n_windows (int): Number of windows, window i holds rows i to i + n_past - 1
+        validation_fraction (float): Part of the time span used for validation
+        validation_start (str | pd.Timestamp): First timestamp of the validation set, overrides the fraction
+
+    Returns:
+        train_starts (np.array), val_starts (np.array): First row of the windows in each set
+    """
+    starts = np.arange(n_windows)
+    if dates is None:
+        boundary = n_windows + n_past - 1 - int(n_windows * validation_fraction)
+    else:
+        dates = pd.DatetimeIndex(dates)
+        if validation_start is None:
+            validation_start = dates[0] + (dates[-1] - dates[0]) * (1 - validation_fraction)
+        boundary = dates.searchsorted(pd.Timestamp(validation_start))
+    return starts[starts + n_past <= boundary], starts[starts >= boundary]
+
+
+def window_dataset(series: np.array, starts: np.array, n_past: int, batch_size: int, shuffle_buffer: int = None):
+    """
+    A tf.data pipeline that cuts the windows out of the scaled series batch by batch
+
+    Only the series and the start index of every window are kept in memory; the windows of a batch are
+    gathered in a parallel map and the next batches are prefetched while the model trains.
+
+    Args:
+        series (np.array): Scaled data of shape (rows, features)
+        starts (np.array): First row of every window, from time_split()
+        n_past (int): Window length
+        batch_size (int): Number of windows per batch
+        shuffle_buffer (int): Size of the shuffle buffer of window starts, no shuffling when None
+
+    Returns:
+        dataset (tf.data.Dataset): Batches of (windows, windows), the autoencoder reconstructs its input
+    """
+    rows = tf.constant(series, dtype=tf.float32)
+    offsets = tf.range(n_past, dtype=tf.int64)
+
+    def cut_windows(batch_starts):
+        windows = tf.gather(rows, batch_starts[:, tf.newaxis] + offsets)  # (batch, n_past, features)
+        return windows, windows
+
+    dataset = tf.data.Dataset.from_tensor_slices(starts.astype(np.int64))
+    if shuffle_buffer:
+        dataset = dataset.shuffle(min(shuffle_buffer, len(starts)), reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size).map(cut_windows, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
 
 
 def lstm_model(ip_arr: np.array):
@@ -19,8 +107,6 @@ def lstm_model(ip_arr: np.array):
         model (keras.models): A model object without any weights
     """
 
-    ip_arr = ip_arr.reshape((ip_arr.shape[0], ip_arr.shape[1],
-                             ip_arr.shape[3]))  # Reshaping the input array to match the input dimensions of the model
     inputs = Input(shape=(ip_arr.shape[1], ip_arr.shape[2]))  # Initializing the input size for the model
 
     L1 = LSTM(48, activation='relu', return_sequences=True, kernel_regularizer=regularizers.l2(0.00))(inputs)  # Model architecture
@@ -35,33 +121,70 @@ def lstm_model(ip_arr: np.array):
     return model
 
 
-def train_model(ip_arr: np.array, model: keras.src.models.functional.Functional, pressure_threshold: float):
+def train_model(ip_arr: np.array, model: keras.src.models.functional.Functional, pressure_threshold: float,
+                epochs: int = EPOCHS, batch_size: int = BATCH_SIZE, learning_rate: float = LEARNING_RATE,
+                patience: int = PATIENCE, checkpoint_dir: str = None, dates=None,
+                validation_fraction: float = VALIDATION_FRACTION, validation_start=None,
+                shuffle_buffer: int = SHUFFLE_BUFFER):
     """
     Training the model using the prepared data
-    Requires data with lagged input features
+    Requires the scaled data, the time lagged windows are cut from it while training (see window_dataset)
+
+    Training stops early once val_loss has not improved for patience epochs, and the weights of the best
+    epoch are kept. With a checkpoint_dir the state is backed up after every epoch, so an interrupted
+    training resumes from the last finished epoch when it is started again.
 
     Args:
-        ip_arr (np.array): Input array with lagged input features for training the model
+        ip_arr (np.array): Scaled data of shape (rows, features), or lagged windows from timelagged()
+        model (keras.models): Model from lstm_model()
+        pressure_threshold (float): Threshold for pressure used to differentiate models
+        epochs (int): Maximum number of epochs
+        batch_size (int): Number of windows per batch
+        learning_rate (float): Learning rate of the Adam optimizer
+        patience (int): Epochs without improvement before stopping
+        checkpoint_dir (str): Directory for the resumable backups, no backups when None
+        dates (pd.DatetimeIndex): Timestamp of every row for the time based validation split
+        validation_fraction (float): Part of the time span used for validation
+        validation_start (str | pd.Timestamp): Start of the validation period, overrides validation_fraction
+        shuffle_buffer (int): Size of the shuffle buffer of the training windows
 
     Returns:
         model (keras) : Model is saved in the path specified
         history (tensorflow.python.keras.callbacks.History) : History from training the model
     """
 
-    ip_arr = ip_arr.reshape((ip_arr.shape[0], ip_arr.shape[1], ip_arr.shape[3]))  # Reshaping the input array to match the input dimensions of the model
-
-    optimizers = keras.optimizers.Adam(learning_rate=0.001)
+    optimizers = keras.optimizers.Adam(learning_rate=learning_rate)
     model.compile(optimizer=optimizers, loss='mae')  # The optimizer and loss function can be changed
 
-    epochs_n = 100  # Parameters can be finetuned
-    batch_n = 128
-
-    pressure_threshold_str = str(pressure_threshold)[1:].replace('.', '_')
-
-    model_save_path = resource_path(rf"Source_file\model_{pressure_threshold_str}.keras")
-    
-    history = model.fit(ip_arr, ip_arr, epochs=epochs_n, batch_size=batch_n, validation_split=0.05, shuffle = True).history
+    model_save_path = model_path(pressure_threshold)
+
+    n_past = model.input_shape[1]
+    if ip_arr.ndim == 3:  # Windows from timelagged(), train on the rows they cover
+        n_windows = len(ip_arr)
+        ip_arr = np.concatenate([ip_arr[:, 0], ip_arr[-1, 1:]]) if n_windows else ip_arr.reshape(0, ip_arr.shape[2])
+    else:
+        n_windows = max(len(ip_arr) - n_past, 0)  # Same windows as timelagged()
+
+    train_starts, val_starts = time_split(dates, n_past, n_windows, validation_fraction, validation_start)
+    logger.info("Training on %d windows, validating on %d windows", len(train_starts), len(val_starts))
+    train_data = window_dataset(ip_arr, train_starts, n_past, batch_size, shuffle_buffer)
+    val_data = window_dataset(ip_arr, val_starts, n_past, batch_size) if len(val_starts) else None
+
+    timer = EpochTimer()
+    callbacks = [
+        keras.callbacks.EarlyStopping(monitor='val_loss' if val_data is not None else 'loss', patience=patience,
+                                      restore_best_weights=True),
+        timer,
+    ]
+    if checkpoint_dir:
+        backup_dir = os.path.join(checkpoint_dir, f"backup_{threshold_suffix(pressure_threshold)}")
+        callbacks.append(keras.callbacks.BackupAndRestore(backup_dir))
+
+    history = model.fit(train_data, validation_data=val_data, epochs=epochs, callbacks=callbacks,
+                        shuffle=False).history  # Shuffled by the dataset
+    history['epoch_seconds'] = timer.seconds
     model.save(model_save_path)  # Location for saving the model file
+    registry.invalidate(pressure_threshold)
 
     return history
 
@@ -80,7 +203,8 @@ def plot_model(history):
 
     fig, ax = plt.subplots(figsize=(14, 6), dpi=100)
     ax.plot(history['loss'], 'b', label='Train', linewidth=2)
-    ax.plot(history['val_loss'], 'r', label='Validation', linewidth=2)
+    if 'val_loss' in history:  # No validation set when the data ends before the validation period
+        ax.plot(history['val_loss'], 'r', label='Validation', linewidth=2)
     ax.set_title('Model Loss')
     ax.set_xlabel('Epochs')
     ax.set_ylabel('Loss (MAE)')
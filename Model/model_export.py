@@ -0,0 +1,202 @@
+""" Export of the trained autoencoders to TensorFlow Lite, and a predictor that runs the export.
+
+The predictor only needs a TFLite interpreter (ai-edge-litert or tflite-runtime), not TensorFlow and Keras,
+so scoring with runtime="tflite" starts faster and uses less memory. Without either package installed the
+interpreter bundled with TensorFlow is used.
+
+Run from the repository root:  python -m Model.model_export normal_operation.csv --quantization float16
+"""
+import logging
+import os
+import tempfile
+import threading
+import numpy as np
+from Model.model_registry import registry, tflite_path, THRESHOLDS
+
+QUANTIZATIONS = (None, "float16", "dynamic", "int8")
+# Accepted difference between the window errors of the export and the Keras model, per quantization, as
+# (absolute, relative): |tflite - keras| <= absolute + relative * |keras|. The anomaly cutoffs are around 0.2
+PARITY_TOLERANCE = {None: (1e-4, 1e-5), "float16": (2e-3, 1e-2), "dynamic": (0.02, 0.1), "int8": (0.02, 0.1)}
+CALIBRATION_WINDOWS = 2000  # Windows used to calibrate the int8 activations
+
+logger = logging.getLogger(__name__)
+
+
+def _interpreter_class():
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+class TFLitePredictor:
+    """
+    Runs an exported model, with the same input_shape and error as the Keras model in results.py
+
+    Args:
+        path (str): Path of the .tflite file
+        num_threads (int): Interpreter threads, all CPUs when None
+    """
+
+    def __init__(self, path: str, num_threads: int = None):
+        self.path = path
+        self.interpreter = _interpreter_class()(model_path=path, num_threads=num_threads or os.cpu_count())
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self.input_shape = (None,) + tuple(int(n) for n in self._input['shape_signature'][1:])
+        self._batch_size = None
+        self._lock = threading.Lock()  # An interpreter runs one batch at a time
+
+    def predict(self, batch: np.array) -> np.array:
+        """ Reconstruction of a batch of windows"""
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        with self._lock:
+            if len(batch) != self._batch_size:  # Resizing reallocates, so only when the batch size changes
+                self.interpreter.resize_tensor_input(self._input['index'], batch.shape)
+                self.interpreter.allocate_tensors()
+                self._batch_size = len(batch)
+            self.interpreter.set_tensor(self._input['index'], batch)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self._output['index'])
+
+    def window_error(self, batch: np.array) -> np.array:
+        """ Mean absolute error per window and time step, like results._error_function"""
+        return np.abs(batch - self.predict(batch)).mean(axis=2)
+
+
+def _unrolled(model):
+    """ A copy of the model with unrolled LSTM layers
+
+    The LSTM loops of Keras become TensorList ops that TFLite cannot convert; with only n_past time steps
+    unrolling them is cheap and gives a graph of plain matrix multiplications.
+    """
+    import keras
+    config = model.get_config()
+    for layer in config["layers"]:
+        if layer["class_name"] == "LSTM":
+            layer["config"]["unroll"] = True
+    unrolled = keras.Model.from_config(config)
+    unrolled.set_weights(model.get_weights())
+    return unrolled
+
+
+def export_tflite(pressure_threshold: float, quantization: str = None, calibration: np.array = None,
+                  version: str = None) -> str:
+    """
+    Converts the Keras model of a threshold to TensorFlow Lite, next to it in Source_file
+
+    Args:
+        pressure_threshold (float): Threshold of the model to export
+        quantization (str): None (float32), "float16" (float16 weights), "dynamic" (int8 weights) or
+            "int8" (int8 weights and activations, needs calibration)
+        calibration (np.array): Scaled time lagged windows of normal operation, to calibrate int8
+        version (str): Model version, see model_registry.model_path
+
+    Returns:
+        path (str): Path of the .tflite file
+    """
+    import tensorflow as tf
+
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantization}, expected one of {QUANTIZATIONS}")
+    if quantization == "int8" and (calibration is None or not len(calibration)):
+        raise ValueError("int8 quantization needs calibration windows")
+
+    model = _unrolled(registry.get_model(pressure_threshold, version))
+    with tempfile.TemporaryDirectory() as saved_model:
+        model.export(saved_model)
+        converter = tf.lite.TFLiteConverter.from_saved_model(saved_model)
+        if quantization:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantization == "float16":
+            converter.target_spec.supported_types = [tf.float16]
+        if quantization == "int8":
+            step = max(1, len(calibration) // CALIBRATION_WINDOWS)
+            samples = np.ascontiguousarray(calibration[::step], dtype=np.float32)
+            converter.representative_dataset = lambda: ([samples[i:i + 1]] for i in range(len(samples)))
+        content = converter.convert()
+
+    path = tflite_path(pressure_threshold, quantization, version)
+    with open(path + ".tmp", "wb") as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+    # Only the predictor of this export, the Keras model and the scaler are unchanged
+    registry.invalidate(pressure_threshold, version, kinds=("tflite" + (f"-{quantization}" if quantization else ""),))
+    logger.info("Exported %s (%.0f kB)", path, len(content) / 1024)
+    return path
+
+
+def check_parity(pressure_threshold: float, windows: np.array, quantization: str = None, version: str = None,
+                 batch_size: int = 4096):
+    """
+    Compares the window errors of the TFLite export with those of the Keras model
+
+    Args:
+        pressure_threshold (float): Threshold of the model
+        windows (np.array): Scaled time lagged windows to compare on
+        quantization (str): Quantization of the export to check
+        version (str): Model version
+        batch_size (int): Windows per batch
+
+    Returns:
+        max_difference (float): Largest absolute difference in the error
+        flag_agreement (float): Fraction of errors on the same side of the error cutoff of anomaly_flag
+        ok (bool): Whether every difference is within PARITY_TOLERANCE
+    """
+    from Model.results import reconstruction_errors, anomaly_cutoffs
+
+    runtime = "tflite" + (f"-{quantization}" if quantization else "")
+    keras_model = registry.get_model(pressure_threshold, version)
+    predictor = registry.get_predictor(pressure_threshold, runtime, version)
+    absolute, relative = PARITY_TOLERANCE[quantization]
+    error_cutoff = anomaly_cutoffs(pressure_threshold, version)[0]
+
+    max_difference, n_agree, n_total, ok = 0.0, 0, 0, True
+    for (_, expected), (_, error) in zip(reconstruction_errors(keras_model, windows, batch_size),
+                                         reconstruction_errors(predictor, windows, batch_size)):
+        difference = np.abs(expected - error)
+        max_difference = max(max_difference, float(difference.max(initial=0)))
+        ok &= bool((difference <= absolute + relative * np.abs(expected)).all())
+        n_agree += int(((expected > error_cutoff) == (error > error_cutoff)).sum())
+        n_total += expected.size
+    return max_difference, n_agree / max(n_total, 1), ok
+
+
+def prepared_windows(file_path: str, pressure_threshold: float) -> np.array:
+    """ The scaled time lagged windows of an export, as score_data prepares them"""
+    from Model.data_loader import data_loader
+    from Model.data_preprocessor import prepare_data, scaled_predict, timelagged
+
+    df = prepare_data(data_loader(file_path))
+    n_past = registry.get_model(pressure_threshold).input_shape[1]
+    return timelagged(scaled_predict(df, pressure_threshold), n_past)
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    from Model.instrumentation import configure_logging
+
+    parser = argparse.ArgumentParser(description="Export the models to TensorFlow Lite and check them against Keras")
+    parser.add_argument("file_path", help="Export of normal operation, for calibration and the parity check")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=list(THRESHOLDS))
+    parser.add_argument("--quantization", choices=[q for q in QUANTIZATIONS if q], nargs="*", default=[],
+                        help="Quantized variants to export next to the float32 model")
+    args = parser.parse_args()
+    configure_logging()
+
+    failed = False
+    for pressure_threshold in args.thresholds:
+        windows = prepared_windows(args.file_path, pressure_threshold)
+        for quantization in [None] + args.quantization:
+            export_tflite(pressure_threshold, quantization, calibration=windows)
+            difference, agreement, ok = check_parity(pressure_threshold, windows, quantization)
+            print(f"[{pressure_threshold}] {quantization or 'float32'}: max error difference {difference:.2e}, "
+                  f"flags agree {agreement:.2%}, {'ok' if ok else 'ABOVE TOLERANCE'}")
+            failed |= not ok
+    sys.exit(1 if failed else 0)
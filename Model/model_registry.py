@@ -0,0 +1,164 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from UI_files.resource_path import resource_path
+from Model.instrumentation import stage
+
+MODEL_DIR = "Source_file"
+THRESHOLDS = (-0.2, -0.25, -0.3)  # Pressure thresholds the shipped models were trained for
+# Inference runtimes: the Keras model, or its TFLite export (see Model/model_export.py), optionally quantized
+RUNTIMES = ("keras", "tflite", "tflite-float16", "tflite-dynamic", "tflite-int8")
+SMALL_KINDS = ("cutoffs",)  # A few floats each, kept outside the LRU cache so they never evict a model
+
+logger = logging.getLogger(__name__)
+
+
+def threshold_suffix(pressure_threshold: float) -> str:
+    """ File name part of a pressure threshold, e.g. -0.25 -> "0_25" """
+    return str(abs(pressure_threshold)).replace('.', '_')
+
+
+def model_path(pressure_threshold: float, version: str = None) -> str:
+    name = f"model_{threshold_suffix(pressure_threshold)}" + (f"_v{version}" if version else "")
+    return resource_path(os.path.join(MODEL_DIR, f"{name}.keras"))
+
+
+def scaler_path(pressure_threshold: float, version: str = None) -> str:
+    name = f"scaler_{threshold_suffix(pressure_threshold)}" + (f"_v{version}" if version else "")
+    return resource_path(os.path.join(MODEL_DIR, f"{name}.save"))
+
+
+def tflite_path(pressure_threshold: float, quantization: str = None, version: str = None) -> str:
+    name = f"model_{threshold_suffix(pressure_threshold)}" + (f"_v{version}" if version else "") \
+        + (f"_{quantization}" if quantization else "")
+    return resource_path(os.path.join(MODEL_DIR, f"{name}.tflite"))
+
+
+def cutoffs_path(pressure_threshold: float, version: str = None) -> str:
+    name = f"cutoffs_{threshold_suffix(pressure_threshold)}" + (f"_v{version}" if version else "")
+    return resource_path(os.path.join(MODEL_DIR, f"{name}.json"))
+
+
+def _load_model(path: str):
+    import keras  # Imported on first use, keras takes seconds to import
+    return keras.models.load_model(path)
+
+
+def _load_scaler(path: str):
+    import joblib
+    return joblib.load(path)
+
+
+def _load_json(path: str):
+    import json
+    with open(path) as f:
+        return json.load(f)
+
+
+def _load_tflite(path: str):
+    from Model.model_export import TFLitePredictor  # Does not import TensorFlow when a TFLite runtime is installed
+    return TFLitePredictor(path)
+
+
+class ModelRegistry:
+    """
+    Loads each (threshold, version) model and scaler once and keeps them in a least recently used cache
+
+    The cutoffs (SMALL_KINDS) are kept in a separate dict that is only emptied by invalidate().
+
+    Args:
+        max_entries (int): Number of models, scalers and TFLite exports kept in memory
+    """
+
+    def __init__(self, max_entries: int = 8):
+        self.max_entries = max_entries
+        self.load_times = {}  # (kind, threshold, version) -> seconds the last load took
+        self._entries = OrderedDict()
+        self._small = {}  # (kind, threshold, version) -> object, for the SMALL_KINDS
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def _get(self, kind: str, pressure_threshold: float, version: str, path: str, loader):
+        key = (kind, pressure_threshold, version)
+        with self._lock:
+            if key in self._small:
+                return self._small[key]
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:  # A second caller waits for the load in progress instead of loading again
+            with self._lock:
+                if key in self._small:
+                    return self._small[key]
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key]
+            start = time.perf_counter()
+            with stage(f"load {kind}", threshold=pressure_threshold, path=path):
+                obj = loader(path)
+            self.load_times[key] = time.perf_counter() - start
+
+            with self._lock:
+                if kind in SMALL_KINDS:
+                    self._small[key] = obj
+                    return obj
+                self._entries[key] = obj
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return obj
+
+    def get_model(self, pressure_threshold: float, version: str = None):
+        path = model_path(pressure_threshold, version)
+        return self._get("model", pressure_threshold, version, path, _load_model)
+
+    def get_scaler(self, pressure_threshold: float, version: str = None):
+        path = scaler_path(pressure_threshold, version)
+        return self._get("scaler", pressure_threshold, version, path, _load_scaler)
+
+    def get_cutoffs(self, pressure_threshold: float, version: str = None):
+        """ The calibration stored by Model/calibration.py, raises FileNotFoundError when there is none"""
+        path = cutoffs_path(pressure_threshold, version)
+        return self._get("cutoffs", pressure_threshold, version, path, _load_json)
+
+    def get_predictor(self, pressure_threshold: float, runtime: str = "keras", version: str = None):
+        """ The Keras model for runtime "keras", or the TFLite export for "tflite" and "tflite-<quantization>" """
+        if runtime == "keras":
+            return self.get_model(pressure_threshold, version)
+        if runtime.partition("-")[0] != "tflite":
+            raise ValueError(f"Unknown inference runtime {runtime}, expected one of {RUNTIMES}")
+        quantization = runtime.partition("-")[2] or None
+        path = tflite_path(pressure_threshold, quantization, version)
+        return self._get(runtime, pressure_threshold, version, path, _load_tflite)
+
+    def invalidate(self, pressure_threshold: float, version: str = None, kinds=None):
+        """ Drops the cached model, scaler, exports and cutoffs of a threshold, e.g. after retraining it.
+        kinds limits it to some of them, e.g. ("tflite-float16",) after a new export."""
+        with self._lock:
+            for cache in (self._entries, self._small):
+                for key in [key for key in cache if key[1:] == (pressure_threshold, version)
+                            and (kinds is None or key[0] in kinds)]:
+                    del cache[key]
+
+    def preload(self, thresholds=THRESHOLDS, version: str = None, background: bool = True):
+        """ Loads the models and scalers of the given thresholds, in a daemon thread when background is True"""
+        def load_all():
+            for pressure_threshold in thresholds:
+                try:
+                    self.get_scaler(pressure_threshold, version)
+                    self.get_model(pressure_threshold, version)
+                except Exception:
+                    logger.exception("Preloading the %s model failed", pressure_threshold)
+
+        if not background:
+            load_all()
+            return None
+        thread = threading.Thread(target=load_all, name="model-preload", daemon=True)
+        thread.start()
+        return thread
+
+
+registry = ModelRegistry()
@@ -1,11 +1,84 @@
+import logging
+import os
 import numpy as np
 import pandas as pd
-import keras as keras
-import matplotlib.pyplot as plt
-from UI_files.resource_path import resource_path
+from Model.data_preprocessor import lagged_batches
+from Model.model_registry import registry, model_path, tflite_path, cutoffs_path
 
+PREDICT_BATCH_SIZE = 4096  # Windows per inference batch, bounds the memory of the predictions
 
-def predict_results(original_df: pd.DataFrame, scaled_arr: np.array, pressure_threshold : float):
+ROLLING_WINDOW = 6  # Number of rows in the rolling AE and DC
+# Per pressure threshold: (error cutoff for the flag, DC cutoff, AE cutoff). Only used for models without a
+# calibration in Source_file, run Model/calibration.py after retraining a model
+ANOMALY_THRESHOLDS = {
+    -0.2: (0.2, 0.6, 0.22),
+    -0.25: (0.2, 0.6, 0.2),
+    -0.3: (0.2, 0.6, 0.2),
+}
+
+logger = logging.getLogger(__name__)
+
+
+def configure_threads(intra_op: int = None, inter_op: int = None):
+    """
+    Sets the size of TensorFlow's thread pools, has to be called before the first model is run
+
+    Args:
+        intra_op (int): Threads used inside a single operation (e.g. a matrix multiplication)
+        inter_op (int): Operations that may run in parallel
+    """
+    import tensorflow as tf
+    if intra_op:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+    if inter_op:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+
+
+def _error_function(model):
+    """ The forward pass plus the error calculation, compiled once per model for any batch size.
+    It is kept on the model, so it is freed with the model when the registry drops it."""
+    window_error = getattr(model, "_anomaly_error_fn", None)
+    if window_error is None:
+        import tensorflow as tf
+        signature = [tf.TensorSpec(shape=(None,) + tuple(model.input_shape[1:]), dtype=tf.float32)]
+
+        @tf.function(input_signature=signature)
+        def window_error(batch):
+            return tf.reduce_mean(tf.abs(batch - model(batch, training=False)), axis=2)
+
+        model._anomaly_error_fn = window_error
+    return window_error
+
+
+def reconstruction_errors(model, windows: np.array, batch_size: int = PREDICT_BATCH_SIZE):
+    """
+    Runs the model over the windows in fixed-size batches and yields the error of each batch
+
+    Args:
+        model (keras.models | TFLitePredictor): Trained autoencoder, or its TFLite export
+        windows (np.array): Time lagged windows from timelagged()
+        batch_size (int): Number of windows per batch
+
+    Yields:
+        offset (int), error (np.array): Index of the first window in the batch and its error per time step
+    """
+    window_error = getattr(model, "window_error", None) or _error_function(model)
+    offset = 0
+    for batch in lagged_batches(windows, batch_size):
+        yield offset, np.asarray(window_error(batch))
+        offset += len(batch)
+
+
+def _overlap_add(calculated_error: np.array, counts: np.array, error: np.array, offset: int):
+    """ Adds the errors of the windows starting at offset onto the rows they cover"""
+    n_windows, n_past = error.shape
+    for j in range(n_past):  # One shifted slice per position in the window
+        calculated_error[offset + j:offset + j + n_windows] += error[:, j]
+        counts[offset + j:offset + j + n_windows] += 1
+
+
+def predict_results(original_df: pd.DataFrame, scaled_arr: np.array, pressure_threshold : float,
+                    batch_size: int = PREDICT_BATCH_SIZE, progress=None, runtime: str = "keras"):
     """
     Given the original dataframe and scaled input form, it predicts the results and returns a dataframe with error
 
@@ -13,29 +86,30 @@ def predict_results(original_df: pd.DataFrame, scaled_arr: np.array, pressure_th
         original_df (pd.DataFrame): Original dataframe to be checked for anomaly
         scaled_arr (np.array): Scaled input array for model
         pressure_threshold (float): Threshold for pressure used to differentiate models
+        batch_size (int): Number of windows per inference batch
+        progress (callable): Called with the fraction of windows done after every batch
+        runtime (str): "keras", or "tflite"/"tflite-<quantization>" for the model exported by model_export.py
 
     Returns:
         error_df (pd.DataFrame): Difference in model prediction with respect to original dataframe
     """
     
-    pressure_threshold_str = str(pressure_threshold)[1:].replace('.', '_')
-    model_path = resource_path(rf"Source_file\model_{pressure_threshold_str}.keras")  # Importing the trained model
-    print("File Path: {}".format(model_path))
-
-    model = keras.models.load_model(model_path)
-    scaled_arr = scaled_arr.reshape((scaled_arr.shape[0], scaled_arr.shape[1],
-                                     scaled_arr.shape[3]))  # Reshaping according to the model input required
+    logger.debug("Model file: %s", model_path(pressure_threshold) if runtime == "keras" else
+                 tflite_path(pressure_threshold, runtime.partition("-")[2] or None))
+    model = registry.get_predictor(pressure_threshold, runtime)  # Importing the trained model, cached after the first run
 
-    predictions = model.predict(scaled_arr)
+    n_past = model.input_shape[1]  # Window length the model was trained with
+    if scaled_arr.shape[1] != n_past:
+        raise ValueError(f"Input windows have length {scaled_arr.shape[1]}, the model expects {n_past}")
 
-    error = np.mean(np.abs(scaled_arr - predictions), axis=2)  # Error calculation column wise and taking the mean
+    # The errors are added onto the rows batch by batch, so only one batch of predictions is ever in memory
     calculated_error = np.zeros(original_df.shape[0])
-    for i in range(len(error)):
-        for j in range(error.shape[1]):
-            calculated_error[i + j] += error[i, j]
-    for i in range(len(calculated_error)):
-        calculated_error[i] = calculated_error[i] / min(i + 1, 2,
-                                                        len(calculated_error) - i)  # loop for error calculation for rows (time frames)
+    counts = np.zeros(original_df.shape[0])
+    for offset, error in reconstruction_errors(model, scaled_arr, batch_size):
+        _overlap_add(calculated_error, counts, error, offset)
+        if progress is not None:
+            progress((offset + len(error)) / len(scaled_arr))
+    np.divide(calculated_error, counts, out=calculated_error, where=counts > 0)
 
     error_df = pd.DataFrame({'Error': calculated_error})
     error_df.set_index(original_df.index, inplace=True)
@@ -43,40 +117,114 @@ def predict_results(original_df: pd.DataFrame, scaled_arr: np.array, pressure_th
     return error_df
 
 
+def anomaly_cutoffs(pressure_threshold: float, version: str = None):
+    """ (error cutoff, DC cutoff, AE cutoff) of a model: its calibration, else the values in ANOMALY_THRESHOLDS"""
+    if os.path.isfile(cutoffs_path(pressure_threshold, version)):
+        calibration = registry.get_cutoffs(pressure_threshold, version)
+        return calibration['error_cutoff'], calibration['dc_cutoff'], calibration['ae_cutoff']
+    if pressure_threshold in ANOMALY_THRESHOLDS:
+        return ANOMALY_THRESHOLDS[pressure_threshold]
+    raise ValueError(f"The {pressure_threshold} model has no cutoffs, calibrate it with Model/calibration.py")
+
+
+def _rolling_sum(values: np.array, window: int, out: np.array):
+    """ Sum over the last window values (fewer at the start, like min_periods=1), from one running sum
+
+    NaNs are skipped like in Series.rolling().sum(), a window without any value sums to NaN."""
+    missing = np.isnan(values) if values.dtype.kind == "f" else None
+    np.cumsum(np.where(missing, 0, values) if missing is not None else values, dtype=out.dtype, out=out)
+    out[window:] -= out[:-window].copy()
+    if missing is not None and missing.any():
+        counts = np.cumsum(~missing)
+        counts[window:] -= counts[:-window].copy()
+        out[counts == 0] = np.nan
+    return out
+
+
+def flag_kernel(error: np.array, error_cutoff: float, dc_cutoff: float, ae_cutoff: float,
+                window: int = ROLLING_WINDOW):
+    """
+    AE, DC and the anomaly mask of a contiguous float32 error array, without any DataFrame in between
+
+    AE is the mean error and DC the fraction of errors above error_cutoff over the last window rows, both
+    divided by the full window at the start like the rolling(min_periods=1) sums they replace. Missing errors
+    (NaN) are left out of the sums, so they do not stop the rows after them from being flagged. The running
+    sums are accumulated in float64, so long series do not drift.
+
+    Args:
+        error (np.array): Error per row
+        error_cutoff (float): Error above which a row counts for DC
+        dc_cutoff (float): DC above which a row can be anomalous
+        ae_cutoff (float): AE above which a row can be anomalous
+        window (int): Number of rows in the rolling AE and DC
+
+    Returns:
+        ae (np.array), dc (np.array), anomaly (np.array): float32 AE and DC and the boolean anomaly mask
+    """
+    error = np.ascontiguousarray(error, dtype=np.float32)
+    running = np.empty(len(error))
+
+    # AE and DC are compared in float64 before the cast, so a value on the cutoff is not rounded over it
+    ae = (_rolling_sum(error, window, running) / window)
+    anomaly = ae > ae_cutoff
+    ae = ae.astype(np.float32)
+    dc = (_rolling_sum(error > error_cutoff, window, running) / window)
+    anomaly &= dc > dc_cutoff
+    dc = dc.astype(np.float32)
+    return ae, dc, anomaly
+
+
+def anomaly_episodes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Groups anomalous rows of consecutive timestamps of a frame from anomaly_flag into episodes
+
+    An episode ends where a row is not anomalous or where the next timestamp is more than one step (the median
+    spacing of the timestamps) later, so anomalies before and after a gap such as a weekend are two episodes.
+
+    Args:
+        df (pd.DataFrame): Frame with Error and Anomaly per timestamp
+
+    Returns:
+        episodes (pd.DataFrame): start, end (last anomalous timestamp), peak_error, duration and rows per episode
+    """
+    index = pd.DatetimeIndex(df.index)
+    step = pd.Series(index).diff().median() if len(index) > 1 else pd.Timedelta(0)
+
+    rows = np.flatnonzero(df['Anomaly'].to_numpy(dtype=bool))
+    times = index[rows]
+    # A new episode starts after a non anomalous row or after a gap in the timestamps
+    new = np.ones(len(rows), dtype=bool)
+    new[1:] = (np.diff(rows) > 1) | (np.diff(times.asi8) > step.value)
+    firsts = np.flatnonzero(new)  # Position in rows of the first row of each episode
+    lasts = np.append(firsts[1:], len(rows))[:len(firsts)] - 1
+
+    error = df['Error'].to_numpy()[rows]
+    peaks = np.maximum.reduceat(error, firsts) if len(firsts) else np.empty(0)
+    episodes = pd.DataFrame({'start': times[firsts], 'end': times[lasts], 'peak_error': peaks,
+                             'rows': lasts - firsts + 1})
+    episodes['duration'] = episodes['end'] - episodes['start'] + step  # A single anomalous minute lasts a minute
+    return episodes
+
+
 def anomaly_flag(df: pd.DataFrame, pressure_threshold: float):
     """
     Given a dataframe with error from model, returns anomaly flag based on two parameters (AE: Average Error & DC: Danger Coefficient)
 
     Args:
         df (pd.DataFrame): Dataframe with error from model
+        pressure_threshold (float): Threshold of the model, selects the cutoffs (see anomaly_cutoffs)
 
     Returns:
         df (pd.DataFrame): Dataframe with calculated parameters (AE & DC) and anomaly flag
     """
 
-    match pressure_threshold:
-
-        case -0.2:
-            df['AE'] = df['Error'].rolling(6, min_periods=1).sum() / 6  # Taking a rolling mean of error based on last 6 values
-            df['flag'] = np.where(df['Error'] > 0.2, 1, 0)
-            df['DC'] = df['flag'].rolling(6, min_periods=1).sum() / 6  # Taking a rolling mean of error flag based on last 6 values
-            df.drop('flag', axis=1, inplace=True)
-            df['Anomaly'] = np.where((df['DC'] > 0.6) & (df['AE'] > 0.22), 1, 0)  # Change the threshold for anomaly flag
-
-        case -0.25:
-            df['AE'] = df['Error'].rolling(6, min_periods=1).sum() / 6  # Taking a rolling mean of error based on last 6 values
-            df['flag'] = np.where(df['Error'] > 0.2, 1, 0)
-            df['DC'] = df['flag'].rolling(6, min_periods=1).sum() / 6  # Taking a rolling mean of error flag based on last 6 values
-            df.drop('flag', axis=1, inplace=True)
-            df['Anomaly'] = np.where((df['DC'] > 0.6) & (df['AE'] > 0.2), 1, 0)  # Change the threshold for anomaly flag
-
-        case -0.3:
-            df['AE'] = df['Error'].rolling(6, min_periods=1).sum() / 6  # Taking a rolling mean of error based on last 6 values
-            df['flag'] = np.where(df['Error'] > 0.2, 1, 0)
-            df['DC'] = df['flag'].rolling(6, min_periods=1).sum() / 6  # Taking a rolling mean of error flag based on last 6 values
-            df.drop('flag', axis=1, inplace=True)
-            df['Anomaly'] = np.where((df['DC'] > 0.6) & (df['AE'] > 0.2), 1, 0)  # Change the threshold for anomaly flag
-
-    indices = df[df['Anomaly'] == 1].index  # Getting the time values where anomalies arose
+    error_cutoff, dc_cutoff, ae_cutoff = anomaly_cutoffs(pressure_threshold)
+
+    ae, dc, anomaly = flag_kernel(df['Error'].to_numpy(), error_cutoff, dc_cutoff, ae_cutoff)
+    df['AE'] = ae  # Rolling mean of the error over the last ROLLING_WINDOW values
+    df['DC'] = dc  # Rolling mean of the error flag over the last ROLLING_WINDOW values
+    df['Anomaly'] = anomaly.view(np.int8)
+
+    indices = df.index[anomaly]  # Getting the time values where anomalies arose
 
     return indices
@@ -0,0 +1,139 @@
+import time
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from Model.data_loader import REQUIRED_COLUMNS, data_loader
+from Model.data_preprocessor import nonProductionMask
+from Model.model_registry import registry
+from Model.results import ROLLING_WINDOW, anomaly_cutoffs, _error_function
+
+AnomalyEvent = namedtuple("AnomalyEvent", ["timestamp", "error", "AE", "DC"])
+
+
+class StreamingDetector:
+    """
+    Anomaly detection one sample at a time, for a live feed of the line
+
+    Only the last n_past scaled rows, the partial errors of the rows that are still covered by future
+    windows and the last ROLLING_WINDOW errors for AE and DC are kept, so every sample costs the same
+    no matter how long the detector runs. The result for a row is final, and equal to what run_model
+    gives for it, once n_past - 1 newer samples have arrived.
+
+    Args:
+        pressure_threshold (float): Threshold of the model to use
+        windows (list): Non-production windows to skip, NON_PRODUCTION_WINDOWS when None
+    """
+
+    def __init__(self, pressure_threshold: float, windows=None):
+        self.model = registry.get_model(pressure_threshold)
+        scaler = registry.get_scaler(pressure_threshold)
+        self.scale = np.asarray(scaler.scale_, dtype=np.float32)  # MinMaxScaler.transform is x * scale_ + min_
+        self.offset = np.asarray(scaler.min_, dtype=np.float32)
+        self.window_error = _error_function(self.model)
+        self.error_cutoff, self.dc_cutoff, self.ae_cutoff = anomaly_cutoffs(pressure_threshold)
+        self.windows = windows
+
+        self.n_past = self.model.input_shape[1]
+        n_features = self.model.input_shape[2]
+        self.rows = np.zeros((self.n_past, n_features), dtype=np.float32)  # Ring buffer of scaled rows
+        self.stamps = [None] * self.n_past
+        self.error_sums = np.zeros(self.n_past)  # Partial error of the rows in the ring buffer
+        self.error_counts = np.zeros(self.n_past)
+        self.recent_errors = np.zeros(ROLLING_WINDOW)  # Ring buffer of the last final row errors
+        self.recent_flags = np.zeros(ROLLING_WINDOW)
+        self.last_values = np.full(n_features, np.nan)
+        self.n_seen = 0
+        self.n_final = 0
+
+    def update(self, timestamp, values):
+        """
+        Adds one sample and returns an AnomalyEvent when the row that became final is anomalous
+
+        Args:
+            timestamp (pd.Timestamp): Time of the sample
+            values (np.array): Values of the REQUIRED_COLUMNS tags, NaN for a missing value
+
+        Returns:
+            event (AnomalyEvent): The anomalous row, or None
+        """
+        if nonProductionMask(pd.Series([pd.Timestamp(timestamp)]), self.windows)[0]:
+            return None
+        values = np.asarray(values, dtype=float)
+        self.last_values = np.where(np.isnan(values), self.last_values, values)  # Forward fill like read_initial_data
+        if np.isnan(self.last_values).any():
+            return None
+
+        slot = self.n_seen % self.n_past
+        self.rows[slot] = self.last_values * self.scale + self.offset
+        self.stamps[slot] = timestamp
+        self.error_sums[slot] = 0
+        self.error_counts[slot] = 0
+        self.n_seen += 1
+        if self.n_seen < self.n_past:
+            return None
+
+        # The window ending at this sample, oldest row first
+        order = (np.arange(self.n_past) + self.n_seen) % self.n_past
+        error = self.window_error(self.rows[order][np.newaxis]).numpy()[0]
+        self.error_sums[order] += error
+        self.error_counts[order] += 1
+
+        # The oldest row in the window is not covered by any later window, so its error is final
+        oldest = order[0]
+        return self._finalize(self.stamps[oldest], self.error_sums[oldest] / self.error_counts[oldest])
+
+    def _finalize(self, timestamp, error: float):
+        slot = self.n_final % ROLLING_WINDOW
+        self.recent_errors[slot] = error
+        self.recent_flags[slot] = error > self.error_cutoff
+        self.n_final += 1
+
+        ae = self.recent_errors.sum() / ROLLING_WINDOW  # Unfilled slots are 0, like min_periods=1 in anomaly_flag
+        dc = self.recent_flags.sum() / ROLLING_WINDOW
+        if dc > self.dc_cutoff and ae > self.ae_cutoff:
+            return AnomalyEvent(timestamp, error, ae, dc)
+        return None
+
+    def run(self, source):
+        """ Yields the anomaly events of a source of (timestamp, values) samples"""
+        for timestamp, values in source:
+            event = self.update(timestamp, values)
+            if event is not None:
+                yield event
+
+
+def replay_file(file_path: str, speed: float = 60.0, max_delay: float = 1.0):
+    """
+    Replays an existing export as a live feed, standing in for the historian
+
+    Args:
+        file_path (str): CSV or Excel export
+        speed (float): Replay speed relative to real time (60 plays one minute of data per second),
+            None replays without waiting
+        max_delay (float): Longest wait between two samples in seconds, so weekends and gaps are skipped
+
+    Yields:
+        timestamp (pd.Timestamp), values (np.array): One sample of the REQUIRED_COLUMNS tags
+    """
+    df = data_loader(file_path)
+    stamps = pd.DatetimeIndex(df["Date"])
+    values = df[REQUIRED_COLUMNS].to_numpy(dtype=float)
+
+    for i in range(len(df)):
+        if speed and i:
+            time.sleep(min((stamps[i] - stamps[i - 1]).total_seconds() / speed, max_delay))
+        yield stamps[i], values[i]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Replay an export through the streaming detector")
+    parser.add_argument("file_path")
+    parser.add_argument("--threshold", type=float, default=-0.25)
+    parser.add_argument("--speed", type=float, default=60.0, help="Replay speed, 0 for as fast as possible")
+    args = parser.parse_args()
+
+    detector = StreamingDetector(args.threshold)
+    for event in detector.run(replay_file(args.file_path, speed=args.speed or None)):
+        print(f"{event.timestamp}  error {event.error:.3f}  AE {event.AE:.3f}  DC {event.DC:.2f}")
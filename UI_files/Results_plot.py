@@ -1,14 +1,38 @@
-from PyQt5.QtWidgets import QSizePolicy, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QComboBox, QLabel, QListWidget
-from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QListWidgetItem
+import logging
+from PyQt5.QtWidgets import (QSizePolicy, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QComboBox, QLabel, QListView,
+                             QLineEdit, QCheckBox, QDoubleSpinBox)
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas, NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
+from matplotlib.patches import Rectangle
+import matplotlib.dates as mdates
 import pandas as pd
 import numpy as np
+from Model.results import anomaly_episodes
+
+SELECTION_SPAN = 1.0  # Days shown around a selected anomaly when the whole series is in view
+
+logger = logging.getLogger(__name__)
+
+def decimate(x, y, n_bins=2000):
+    """ Min/max decimation: keeps the lowest and highest point of each of n_bins equal bins, in time order.
+
+    The shape of the series, including short spikes, stays visible with at most 2 * n_bins points."""
+    if len(x) <= 2 * n_bins:
+        return x, y
+    per_bin = len(x) // n_bins
+    usable = per_bin * n_bins
+    bins = y[:usable].reshape(n_bins, per_bin)
+    starts = np.arange(n_bins) * per_bin
+    lows = starts + bins.argmin(axis=1)
+    highs = starts + bins.argmax(axis=1)
+    keep = np.sort(np.concatenate([lows, highs, np.arange(usable, len(x))]))
+    return x[keep], y[keep]
+
 
 class PlotCanvas(FigureCanvas):
     """ Class to create a plot canvas for the plot window."""
-    def __init__(self, parent=None, width=5, height=4, dpi=100):
+    def __init__(self, parent=None, width=5, height=4, dpi=100, n_bins=2000):
         self.fig = Figure(figsize=(width, height), dpi=dpi)
         self.axes = self.fig.add_subplot(111)
         super().__init__(self.fig)
@@ -16,63 +40,250 @@ class PlotCanvas(FigureCanvas):
         FigureCanvas.setSizePolicy(self, QSizePolicy.Expanding, QSizePolicy.Expanding)
         FigureCanvas.updateGeometry(self)
 
-    def plot(self, new_data, y_col, predictions=None, selected_prediction=None, clogs=None):
-        try:
-            self.axes.clear()
+        self.n_bins = n_bins
+        self.data = None  # The DataFrame the caches below belong to
+        self.x = None  # Dates as matplotlib date numbers, parsed once per DataFrame
+        self.order = None
+        self.columns = {}  # y_col -> (x, y) without missing values, in time order
+        self.markers = {}  # id of a list of datetimes -> date numbers
+        self.line = None
+        self.y_col = None
+        self.selection = None  # (start, end) date numbers of the highlighted anomaly
+        self.highlightPatch = None
+
+    def setData(self, new_data):
+        """ Parses and sorts the dates of a new DataFrame once and clears the per column cache."""
+        if 'Date' not in new_data.columns:
+            raise ValueError("The DataFrame must contain a 'Date' column.")
+        dates = pd.to_datetime(new_data['Date'], errors='coerce')
+        x = mdates.date2num(dates.to_numpy())
+        self.order = np.argsort(x, kind='stable')  # Already sorted exports keep their order
+        self.x = x[self.order]
+        self.data = new_data
+        self.columns = {}
+
+    def series(self, y_col):
+        if y_col not in self.columns:
+            y = self.data[y_col].to_numpy(dtype=float)[self.order]
+            valid = ~(np.isnan(self.x) | np.isnan(y))  # Rows where the date or the value is missing
+            self.columns[y_col] = (self.x[valid], y[valid])
+        return self.columns[y_col]
+
+    def markerDates(self, dates):
+        key = id(dates)
+        if key not in self.markers:
+            self.markers[key] = (dates, mdates.date2num(pd.to_datetime(pd.Series(dates)).to_numpy()))
+        return self.markers[key][1]
 
-            # Ensure the 'Date' column is in datetime format and set as index
-            if 'Date' not in new_data.columns:
-                raise ValueError("The DataFrame must contain a 'Date' column.")
+    def visiblePoints(self, lo=None, hi=None):
+        """ The decimated points of the current column between lo and hi (date numbers)."""
+        x, y = self.series(self.y_col)
+        start = 0 if lo is None else max(np.searchsorted(x, lo) - 1, 0)
+        stop = len(x) if hi is None else np.searchsorted(x, hi) + 1
+        return decimate(x[start:stop], y[start:stop], self.n_bins)
 
-            # Convert 'Date' column to datetime
-            new_data['Date'] = pd.to_datetime(new_data['Date'], errors='coerce')
-            new_data = new_data.dropna(subset=['Date'])  # Drop rows where 'Date' could not be converted
-            new_data.set_index('Date', inplace=True)
+    def onXlimChanged(self, axes):
+        # Zooming or panning with the toolbar: fetch the detail of the visible interval only
+        if self.line is None:
+            return
+        lo, hi = axes.get_xlim()
+        self.line.set_data(*self.visiblePoints(lo, hi))
+        self.draw_idle()
 
-            # Drop any rows with NaT values in y_col
-            new_data = new_data.dropna(subset=[y_col])
+    def drawHighlight(self):
+        start, end = self.selection
+        width = max(end - start, 1 / (24 * 60))  # At least a minute, so a single anomalous minute is visible
+        if self.highlightPatch is None:
+            self.highlightPatch = Rectangle((start, 0), width, 1, transform=self.axes.get_xaxis_transform(),
+                                            color='orange', alpha=0.4, zorder=3)
+            self.axes.add_patch(self.highlightPatch)
+        else:
+            self.highlightPatch.set_x(start)
+            self.highlightPatch.set_width(width)
 
-            # Plot the data
-            self.axes.plot(new_data.index, new_data[y_col])
+    def highlight(self, start, end):
+        """ Moves the highlight to the anomaly between start and end and centers the view on it.
+
+        Only the highlight and the x limits change; the line is refetched for the new interval by onXlimChanged."""
+        self.selection = (mdates.date2num(pd.Timestamp(start)), mdates.date2num(pd.Timestamp(end)))
+        if self.line is None:
+            return
+        self.drawHighlight()
+
+        x, _ = self.series(self.y_col)
+        lo, hi = self.axes.get_xlim()
+        view = hi - lo
+        if view >= 0.99 * (x[-1] - x[0]):  # Whole series in view: zoom in around the anomaly
+            view = max(SELECTION_SPAN, 4 * (self.selection[1] - self.selection[0]))
+        center = (self.selection[0] + self.selection[1]) / 2
+        self.axes.set_xlim(center - view / 2, center + view / 2)
+        self.draw_idle()
+
+    def plot(self, new_data, y_col, predictions=None, clogs=None):
+        try:
+            if new_data is not self.data:
+                self.setData(new_data)
+            self.y_col = y_col
+            self.line = None
+            self.highlightPatch = None  # Removed by clear(), drawn again below for the selection
+            self.axes.clear()
+            self.axes.callbacks.connect('xlim_changed', self.onXlimChanged)  # clear() drops the callbacks
+            self.axes.xaxis_date()
+
+            x, y = self.series(y_col)
+            if len(x) == 0:
+                raise ValueError(f"No data to plot for {y_col}")
+
+            # Plot the data, decimated to the resolution of the screen
+            self.line, = self.axes.plot(*self.visiblePoints())
             self.axes.set_title(f'Plot: {y_col}')
             self.axes.set_xlabel('Date')
             self.axes.set_ylabel(y_col)
 
-            # Add vertical lines for each datetime in predictions
-            if predictions is not None:
-                for prediction in predictions:
-                    line_width = 2 if prediction == selected_prediction else 1
-                    self.axes.axvline(x=prediction, color='r', linestyle='--', linewidth=line_width)
+            # One collection of vertical lines for all predictions, the selection is a separate highlight
+            if predictions is not None and len(predictions):
+                marks = self.markerDates(predictions)
+                self.axes.vlines(marks, 0, 1, transform=self.axes.get_xaxis_transform(), colors='r',
+                                 linestyles='--', linewidth=1)
+            if self.selection is not None:
+                self.drawHighlight()
 
             # Add vertical lines for each datetime in clog_data
-            if clogs is not None:
-                clog_dates = clogs["Date"]
-                for clog in clog_dates:
-                    self.axes.axvline(x=clog, color='b', linestyle='-', linewidth=2)
+            if clogs is not None and len(clogs):
+                self.axes.vlines(self.markerDates(clogs["Date"]), 0, 1, transform=self.axes.get_xaxis_transform(),
+                                 colors='b', linestyles='-', linewidth=2)
 
-            # Set x-axis ticks to show only 20 evenly spaced points
-            x_ticks = np.linspace(0, len(new_data.index) - 1, 20, dtype=int)
-            self.axes.set_xticks(new_data.index[x_ticks])
-            self.axes.set_xticklabels(new_data.index[x_ticks].strftime('%Y-%m-%d %H:%M:%S'), rotation=45, ha='right')
+            # Show about 20 date ticks, also after zooming
+            self.axes.xaxis.set_major_locator(mdates.AutoDateLocator(maxticks=20))
+            self.axes.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d %H:%M:%S'))
+            for label in self.axes.get_xticklabels():
+                label.set_rotation(45)
+                label.set_ha('right')
+            self.axes.set_xlim(x[0], x[-1])
 
             # Set y-axis limits and ticks
-            y_min, y_max = new_data[y_col].min(), new_data[y_col].max()
+            y_min, y_max = y.min(), y.max()
             self.axes.set_ylim([y_min, y_max])
             self.axes.set_yticks(np.linspace(y_min, y_max, 10))
 
-            self.draw()
-        except Exception as e:
-            print(f"Error in plot: {e}")
+            self.draw_idle()
+        except Exception:
+            logger.exception("Plotting %s failed", y_col)
+
+
+class AnomalyListModel(QAbstractListModel):
+    """
+    List model over the anomalies, as episodes or as single timestamps
+
+    The anomalies are kept in numpy arrays and a row is only formatted when the view asks for it, so the list
+    costs the same for ten anomalies as for a hundred thousand. Sorting and filtering reorder an index array.
+
+    Args:
+        predictions (pd.DatetimeIndex): Anomalous timestamps
+        scores (pd.DataFrame): Error and Anomaly per timestamp from score_data, needed for episodes and severity
+    """
+
+    SORT_KEYS = ("Time", "Severity")
+
+    def __init__(self, predictions=None, scores=None, parent=None):
+        super().__init__(parent)
+        if scores is not None and 'Anomaly' in scores.columns:
+            episodes = anomaly_episodes(scores)
+            anomalous = scores[scores['Anomaly'] == 1]
+            minutes = pd.DataFrame({'start': anomalous.index, 'end': anomalous.index,
+                                    'peak_error': anomalous['Error'].to_numpy(), 'rows': 1})
+        else:  # Only the timestamps are known, every anomaly is its own row
+            minutes = pd.DataFrame({'start': pd.DatetimeIndex(predictions if predictions is not None else []),
+                                    'peak_error': np.nan, 'rows': 1})
+            minutes['end'] = minutes['start']
+            episodes = None
+        self.modes = {False: self._arrays(minutes)}
+        if episodes is not None:
+            self.modes[True] = self._arrays(episodes)
+        self.grouped = True in self.modes
+        self.sortKey = "Time"
+        self.filterText = ""
+        self.minPeak = 0.0
+        self.order = np.arange(len(self.rows['start']))
+
+    @staticmethod
+    def _arrays(frame):
+        return {'start': frame['start'].to_numpy(dtype='datetime64[ns]'),
+                'end': frame['end'].to_numpy(dtype='datetime64[ns]'),
+                'peak': frame['peak_error'].to_numpy(dtype=float),
+                'rows': frame['rows'].to_numpy(),
+                'text': None}  # Start times as text, made on the first text filter
+
+    @property
+    def rows(self):
+        return self.modes[self.grouped]
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.order)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.order):
+            return None
+        row = self.order[index.row()]
+        start = pd.Timestamp(self.rows['start'][row])
+        if role == Qt.DisplayRole:
+            peak = self.rows['peak'][row]
+            severity = "" if np.isnan(peak) else f"  peak {peak:.3f}"
+            if not self.grouped:
+                return start.strftime('%Y-%m-%d %H:%M:%S') + severity
+            return f"{start:%Y-%m-%d %H:%M}  {self.rows['rows'][row]} min{severity}"
+        if role == Qt.UserRole:
+            return start, pd.Timestamp(self.rows['end'][row])
+        return None
+
+    def setGrouped(self, grouped: bool):
+        if grouped in self.modes and grouped != self.grouped:
+            self.grouped = grouped
+            self.update(np.arange(len(self.rows['start'])))
+
+    def setSortKey(self, key: str):
+        self.sortKey = key
+        self.update(self.order)
+
+    def setFilter(self, text: str, min_peak: float = 0.0):
+        """ Keeps the rows whose start contains text and whose peak error is at least min_peak.
+
+        When the new filter only narrows the previous one (more text typed, higher minimum), only the rows
+        that are shown now are checked again."""
+        narrows = text.startswith(self.filterText) and min_peak >= self.minPeak
+        candidates = self.order if narrows else np.arange(len(self.rows['start']))
+        self.filterText, self.minPeak = text, min_peak
+        self.update(candidates)
+
+    def update(self, candidates):
+        rows = self.rows
+        keep = np.ones(len(candidates), dtype=bool)
+        if self.filterText:
+            if rows['text'] is None:
+                rows['text'] = np.char.replace(np.datetime_as_string(rows['start'], unit='s'), 'T', ' ')
+            keep &= np.char.find(rows['text'][candidates], self.filterText) >= 0
+        if self.minPeak > 0:
+            keep &= ~(rows['peak'][candidates] < self.minPeak)  # Rows without a known peak stay
+        candidates = candidates[keep]
+
+        if self.sortKey == "Severity":
+            candidates = candidates[np.argsort(-np.nan_to_num(rows['peak'][candidates], nan=-np.inf), kind='stable')]
+        else:
+            candidates = np.sort(candidates)  # Rows are stored in time order
+
+        self.beginResetModel()
+        self.order = candidates
+        self.endResetModel()
 
 
 class PlotWindow(QMainWindow):
     """ Class to create a window for plotting the results."""
-    def __init__(self, new_data, predictions=None, clog_data=None):
+    def __init__(self, new_data, predictions=None, clog_data=None, scores=None):
         super().__init__()
         self.new_data = new_data
         self.predictions = predictions
         self.clog_data = clog_data
-        self.selected_prediction = None
+        self.scores = scores
         self.initUI()
 
     def initUI(self):
@@ -86,17 +297,35 @@ class PlotWindow(QMainWindow):
         # Create a layout for the predictions list
         self.predictionsLayout = QVBoxLayout()
         self.predictionsLabel = QLabel("Possible Clog Moments")
-        self.predictionsList = QListWidget(self)
-
-        if self.predictions is not None:
-            for prediction in self.predictions:
-                item = QListWidgetItem(prediction.strftime('%Y-%m-%d %H:%M:%S'))
-                item.setData(Qt.UserRole, prediction)
-                self.predictionsList.addItem(item)
+        self.predictionsModel = AnomalyListModel(self.predictions, self.scores, self)
+        self.predictionsList = QListView(self)
+        self.predictionsList.setUniformItemSizes(True)  # Lets the view skip measuring every row
+        self.predictionsList.setModel(self.predictionsModel)
+        self.predictionsList.selectionModel().currentChanged.connect(self.onPredictionSelected)
 
-        self.predictionsList.itemClicked.connect(self.onPredictionSelected)
+        # Grouping, sorting and filtering of the list
+        self.groupCheckBox = QCheckBox("Group into episodes", self)
+        self.groupCheckBox.setChecked(self.predictionsModel.grouped)
+        self.groupCheckBox.setEnabled(True in self.predictionsModel.modes)
+        self.groupCheckBox.toggled.connect(self.predictionsModel.setGrouped)
+        self.sortComboBox = QComboBox(self)
+        self.sortComboBox.addItems(AnomalyListModel.SORT_KEYS)
+        self.sortComboBox.currentTextChanged.connect(self.predictionsModel.setSortKey)
+        self.filterEdit = QLineEdit(self)
+        self.filterEdit.setPlaceholderText("Filter, e.g. 2024-03-1")
+        self.filterEdit.textChanged.connect(self.onFilterChanged)
+        self.minPeakSpinBox = QDoubleSpinBox(self)
+        self.minPeakSpinBox.setPrefix("Peak error \u2265 ")
+        self.minPeakSpinBox.setDecimals(3)
+        self.minPeakSpinBox.setSingleStep(0.05)
+        self.minPeakSpinBox.setMaximum(1e6)
+        self.minPeakSpinBox.valueChanged.connect(self.onFilterChanged)
 
         self.predictionsLayout.addWidget(self.predictionsLabel)
+        self.predictionsLayout.addWidget(self.groupCheckBox)
+        self.predictionsLayout.addWidget(self.sortComboBox)
+        self.predictionsLayout.addWidget(self.filterEdit)
+        self.predictionsLayout.addWidget(self.minPeakSpinBox)
         self.predictionsLayout.addWidget(self.predictionsList)
 
         # Create a layout for the plot
@@ -130,8 +359,13 @@ class PlotWindow(QMainWindow):
 
     def updatePlot(self):
         y_col = self.yColumnComboBox.currentText()
-        self.canvas.plot(self.new_data, y_col, self.predictions, self.selected_prediction, self.clog_data)
+        self.canvas.plot(self.new_data, y_col, self.predictions, self.clog_data)
 
-    def onPredictionSelected(self, item):
-        self.selected_prediction = item.data(Qt.UserRole)
-        self.updatePlot()
+    def onFilterChanged(self):
+        self.predictionsModel.setFilter(self.filterEdit.text().strip(), self.minPeakSpinBox.value())
+
+    def onPredictionSelected(self, current, previous=None):
+        # Only the highlight moves, the series itself is not plotted again
+        selection = self.predictionsModel.data(current, Qt.UserRole)
+        if selection is not None:
+            self.canvas.highlight(*selection)
@@ -1,94 +1,269 @@
+import logging
+import multiprocessing
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
-from Model.data_preprocessor import read_initial_data, outlier_treatment, clearWeekends, scaled_predict, timelagged, \
-    scaled_train
-from Model.results import predict_results, anomaly_flag
-from Model.model_builder import lstm_model, train_model , plot_model
+from Model.data_loader import data_loader
+from Model.model_registry import THRESHOLDS, registry, threshold_suffix
+from Model.data_preprocessor import prepare_data, outlier_treatment, scaled_predict, timelagged, scaled_train
+from Model.results import predict_results, anomaly_flag, configure_threads, PREDICT_BATCH_SIZE
+from Model.instrumentation import stage, labels, configure_worker
 from UI_files.resource_path import resource_path
 
 
-def run_model(file_path, new_data, pressure_threshold : float):
-    """ Run the model with the given file path and new data."""
+# Pipeline stages in the order they run, reported through the progress callback of score_data
+STAGES = ["load", "clear weekends", "prepare", "scale", "lag", "predict", "flag"]
 
-    file_path = resource_path(file_path)
-    print(f"Running model with file: {file_path}")
+logger = logging.getLogger(__name__)
 
-    try:
-        # 1. Preprocessing
-        print("Starting preprocessing...")
-        prediction_data = clearWeekends(new_data)
-        print('Cleared weekends')
 
-        # Perform Initial Setup
-        prediction_data = read_initial_data(prediction_data)
-        print('Intial setup complete')
+class PipelineCancelled(Exception):
+    """ Raised from a progress callback to stop the pipeline between two steps."""
 
+
+def score_prepared(prediction_data, pressure_threshold: float, batch_size: int = PREDICT_BATCH_SIZE, progress=None,
+                   runtime: str = "keras"):
+    """ Scales, lags and scores data from prepare_data (Model/data_preprocessor.py) with the model of one threshold.
+    Returns the frame with Error, AE, DC and Anomaly per timestamp and the anomaly timestamps."""
+    if progress is None:
+        progress = lambda stage, fraction=0.0: None
+
+    with labels(threshold=pressure_threshold):
         #Scaling the prediciton values
-        preprocess_data = scaled_predict(prediction_data, pressure_threshold)
-        print('Scaled data')
+        progress("scale")
+        with stage("scaled_predict") as record:
+            preprocess_data = scaled_predict(prediction_data, pressure_threshold)
+            record["rows"] = len(preprocess_data)
 
         #Creating time lagged inputs
-        preprocess_data = timelagged(preprocess_data, n_past=2)  # Example value for n_past
-        print('Applied time lagging')
-
-        print('Preprocessing done')
+        progress("lag")
+        n_past = registry.get_predictor(pressure_threshold, runtime).input_shape[1]  # Window length of the model
+        with stage("timelagged") as record:
+            preprocess_data = timelagged(preprocess_data, n_past=n_past)
+            record["rows"] = len(preprocess_data)
 
         # 2. Predicting with the model
-        predictions = predict_results(prediction_data, preprocess_data, pressure_threshold)
-        print('Predictions done')
+        progress("predict")
+        with stage("predict_results", runtime=runtime) as record:
+            predictions = predict_results(prediction_data, preprocess_data, pressure_threshold, batch_size=batch_size,
+                                          progress=lambda fraction: progress("predict", fraction), runtime=runtime)
+            record["rows"] = len(predictions)
+
+        progress("flag")
+        with stage("anomaly_flag") as record:
+            anomaly_predictions = anomaly_flag(predictions, pressure_threshold)
+            record["rows"] = len(predictions)
+            record["anomalies"] = len(anomaly_predictions)
+
+    return predictions, anomaly_predictions
+
+
+def score_data(new_data, pressure_threshold: float, batch_size: int = PREDICT_BATCH_SIZE, progress=None,
+               runtime: str = "keras"):
+    """ Preprocess the data and score it with the model of the given threshold.
+
+    progress is called as progress(stage, fraction) at the start of every stage in STAGES and after every
+    inference batch; it may raise PipelineCancelled to stop the run. runtime selects the Keras model or its
+    TFLite export, see Model/model_registry.RUNTIMES.
+    Returns the frame with Error, AE, DC and Anomaly per timestamp and the anomaly timestamps."""
+    prediction_data = prepare_data(new_data, progress)
+    return score_prepared(prediction_data, pressure_threshold, batch_size, progress, runtime)
+
+
+def score_thresholds(new_data, thresholds=THRESHOLDS, batch_size: int = PREDICT_BATCH_SIZE, progress=None,
+                     runtime: str = "keras", failures: dict = None):
+    """ Scores the data with the models of several thresholds, the data is loaded and cleaned only once.
+
+    progress is called like in score_data; the scoring of all thresholds is reported as the predict stage.
+    When a failures dict is given, a threshold that fails to score is logged and left out of the frame and
+    its exception is stored in failures, so the other thresholds are still scored.
+    Returns one frame with a column per (threshold, Error/AE/DC/Anomaly) and a dict of threshold -> anomaly
+    timestamps."""
+    if progress is None:
+        progress = lambda stage, fraction=0.0: None
+    thresholds = list(thresholds)
+    prediction_data = prepare_data(new_data, progress)
+
+    frames, anomalies = {}, {}
+    for i, pressure_threshold in enumerate(thresholds):
+        def threshold_progress(stage, fraction=0.0, i=i):
+            progress("predict", (i + (fraction if stage == "predict" else 0.0)) / len(thresholds))
+
+        try:
+            frames[pressure_threshold], anomalies[pressure_threshold] = score_prepared(
+                prediction_data, pressure_threshold, batch_size, threshold_progress, runtime)
+        except PipelineCancelled:
+            raise
+        except Exception as e:
+            if failures is None:
+                raise
+            logger.exception("Scoring with threshold %s failed", pressure_threshold)
+            failures[pressure_threshold] = e
+    progress("flag")
+
+    combined = pd.concat(frames, axis=1, names=["Threshold", None]) if frames else \
+        pd.DataFrame(index=prediction_data.index)
+    return combined, anomalies
+
+
+# combined is the frame of score_thresholds, shared by the results of all thresholds of the file
+ScoreResult = namedtuple("ScoreResult", ["file_path", "pressure_threshold", "errors", "anomalies", "failure",
+                                         "combined"], defaults=[None])
+
+
+def _score_file(file_path, thresholds, batch_size: int, runtime: str = "keras"):
+    """ Loads and cleans one file once and scores it with every threshold, a failure is logged and returned
+    rather than raised"""
+    with labels(file=file_path):
+        failures = {}
+        try:
+            combined, anomalies = score_thresholds(data_loader(file_path), thresholds, batch_size, runtime=runtime,
+                                                   failures=failures)
+        except Exception as e:
+            logger.exception("Loading %s failed", file_path)
+            return [ScoreResult(file_path, pressure_threshold, None, None, f"Loading failed: {e}")
+                    for pressure_threshold in thresholds]
 
-        anomaly_predictions = anomaly_flag(predictions, pressure_threshold)
-        print('Anomaly detection done')
+        results = []
+        for pressure_threshold in thresholds:
+            if pressure_threshold in failures:
+                failure = f"Scoring failed: {failures[pressure_threshold]}"
+                results.append(ScoreResult(file_path, pressure_threshold, None, None, failure))
+            else:
+                results.append(ScoreResult(file_path, pressure_threshold, combined[pressure_threshold],
+                                           anomalies[pressure_threshold], None, combined))
+        return results
 
-        print(f'Anomaly list : {anomaly_predictions}')
 
-        return new_data, anomaly_predictions  # returning data to be plotted
+def _init_worker(threads: int, runtime: str = "keras"):
+    configure_worker()
+    if runtime == "keras":  # The TFLite runtimes run without TensorFlow, importing it would only cost time
+        configure_threads(threads, 1)  # Before the worker loads its own copy of the models
 
-    except Exception as e:
-        print(f"An error occurred: {e}")
 
+def score_files(file_paths, thresholds=THRESHOLDS, workers: int = 1, threads_per_worker: int = 1,
+                batch_size: int = PREDICT_BATCH_SIZE, runtime: str = "keras"):
+    """ Scores many files with many thresholds and yields a ScoreResult per (file, threshold).
+
+    With workers > 1 the files are spread over a pool of processes, each with its own models
+    and, with the keras runtime, threads_per_worker TensorFlow threads; workers of the TFLite runtimes
+    do not import TensorFlow. The results always come in the order of file_paths and thresholds."""
+    file_paths = list(file_paths)
+    thresholds = list(thresholds)
+    if workers <= 1:
+        for file_path in file_paths:
+            yield from _score_file(file_path, thresholds, batch_size, runtime)
+        return
+
+    context = multiprocessing.get_context("spawn")  # TensorFlow is not safe to fork once it is initialized
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(threads_per_worker, runtime)) as pool:
+        jobs = pool.map(_score_file, file_paths, [thresholds] * len(file_paths), [batch_size] * len(file_paths),
+                        [runtime] * len(file_paths))
+        for results in jobs:
+            yield from results
+
+
+def run_model(file_path, new_data, pressure_threshold : float):
+    """ Run the model with the given file path and new data. Errors of the pipeline are raised, not returned."""
 
-def train_model(file_path, new_data, pressure_threshold : float):
-    """ Train the model with the given file path and new data, this can be used for retrain if needed in the future"""
     file_path = resource_path(file_path)
-    print(f"Running model with file: {file_path}")
+    logger.info("Running model with file: %s", file_path)
 
-    try:
-        # 1. Preprocessing
-        print("Starting preprocessing...")
+    with labels(file=file_path):
+        _, anomaly_predictions = score_data(new_data, pressure_threshold)
+    logger.info("%d anomalous timestamps", len(anomaly_predictions))
 
-        full_data = clearWeekends(new_data)
-        print('Cleared weekends')
+    return new_data, anomaly_predictions  # returning data to be plotted
 
-        # Initial Setup
-        full_data = read_initial_data(full_data)
-        print('Initial setup done')
 
+def _train_threshold(full_data, pressure_threshold: float, options: dict):
+    """ Trains the model of one threshold on the shared preprocessed data and returns its history"""
+    # Imports TensorFlow, only for training
+    from Model.model_builder import lstm_model, train_model as fit_model, N_PAST
+    with labels(threshold=pressure_threshold):
         #Outlier Treatment
-        preprocess_data = outlier_treatment(full_data, pressure_threshold=pressure_threshold)
-        print('Outlier Treatment done')
-        
+        with stage("outlier_treatment", rows=len(full_data)):
+            preprocess_data = outlier_treatment(full_data.copy(), pressure_threshold=pressure_threshold)
+
         #Scaling the values
-        preprocess_data = scaled_train(preprocess_data, pressure_threshold)
-        print('Scaled data')
+        dates = preprocess_data.index
+        with stage("scaled_train", rows=len(preprocess_data)):
+            preprocess_data = scaled_train(preprocess_data, pressure_threshold)
 
-        #Create time lagged features
-        preprocess_data = timelagged(preprocess_data, n_past=2)  # Example value for n_past
-        print('Applied time lagging')
+        # Training the model, the time lagged windows are cut from the scaled data while training
+        with stage("train_model", rows=len(preprocess_data)) as record:
+            model = lstm_model(timelagged(preprocess_data, n_past=N_PAST))
+            history = fit_model(preprocess_data, model, pressure_threshold, dates=dates, **options)
+            record["epochs"] = len(history["loss"])
+    return history
 
-        print('Preprocessing done')
 
-        # 2. Training the model
-        model = lstm_model(preprocess_data)
-        print('Predictions done')
+def _train_worker(full_data, pressure_threshold: float, options: dict, threads: int):
+    configure_worker()
+    configure_threads(threads, 1)
+    return _train_threshold(full_data, pressure_threshold, options)
+
+
+def write_training_report(history: dict, path: str):
+    """ Writes the time, loss and val_loss of every epoch to a CSV file"""
+    report = pd.DataFrame({'epoch': np.arange(1, len(history['epoch_seconds']) + 1),
+                           'seconds': history['epoch_seconds'],
+                           'loss': history['loss'],
+                           'val_loss': history.get('val_loss', np.nan)})
+    report.to_csv(path, index=False)
 
-        history = train_model(preprocess_data, model, pressure_threshold)
-        print('Training done')
 
-        fig = plot_model(history)
+def train_thresholds(new_data, thresholds=THRESHOLDS, workers: int = 1, threads_per_worker: int = None,
+                     report_dir: str = None, **options):
+    """ Trains the models of several thresholds on the same data.
+
+    The weekend and initial setup preprocessing is shared. With workers > 1 the thresholds are trained
+    at the same time in separate processes, each with threads_per_worker TensorFlow threads, otherwise
+    they are trained back to back. The options (epochs, batch_size, learning_rate, patience,
+    checkpoint_dir) are passed to Model.model_builder.train_model.
+    Returns a dict of threshold -> history, with the seconds per epoch under 'epoch_seconds'."""
+    thresholds = list(thresholds)
+    full_data = prepare_data(new_data)
+
+    if workers <= 1:
+        histories = [_train_threshold(full_data, pressure_threshold, options) for pressure_threshold in thresholds]
+    else:
+        if threads_per_worker is None:
+            threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+        context = multiprocessing.get_context("spawn")  # TensorFlow is not safe to fork once it is initialized
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            jobs = [pool.submit(_train_worker, full_data, pressure_threshold, options, threads_per_worker)
+                    for pressure_threshold in thresholds]
+            histories = [job.result() for job in jobs]
+        for pressure_threshold in thresholds:
+            registry.invalidate(pressure_threshold)  # The workers saved new models, drop the ones cached here
+
+    if report_dir:
+        os.makedirs(report_dir, exist_ok=True)
+        for pressure_threshold, history in zip(thresholds, histories):
+            write_training_report(history, os.path.join(report_dir,
+                                                        f"training_report_{threshold_suffix(pressure_threshold)}.csv"))
+    return dict(zip(thresholds, histories))
+
+
+def train_model(file_path, new_data, pressure_threshold : float, **options):
+    """ Train the model with the given file path and new data, this can be used for retrain if needed in the future.
+    Errors of the pipeline are raised, not returned."""
+    file_path = resource_path(file_path)
+    logger.info("Training model with file: %s", file_path)
+
+    with labels(file=file_path):
+        # 1. Preprocessing
+        full_data = prepare_data(new_data)
+
+        # 2. Training the model
+        history = _train_threshold(full_data, pressure_threshold, options)
 
-        return fig  # returning the training figure for visual inspection
+    from Model.model_builder import plot_model
+    fig = plot_model(history)
 
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    return fig  # returning the training figure for visual inspection
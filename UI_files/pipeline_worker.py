@@ -0,0 +1,51 @@
+import logging
+import threading
+from PyQt5.QtCore import QObject, pyqtSignal
+from Model.instrumentation import labels
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineWorker(QObject):
+    """ Runs data loading and the model pipeline on a worker thread, so the window stays responsive."""
+
+    progress = pyqtSignal(str, int)  # Signal that emits the current stage and the overall progress in percent
+    finished = pyqtSignal(object, object, object)  # Signal that emits the loaded data, the anomaly timestamps and the scores
+    failed = pyqtSignal(str)  # Signal that emits an error message when a stage raised
+    cancelled = pyqtSignal()  # Signal that is emitted when the run stopped after cancel()
+
+    def __init__(self, file_path, pressure_threshold):
+        super().__init__()
+        self.file_path = file_path
+        self.pressure_threshold = pressure_threshold
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        """ Asks the pipeline to stop at the next stage or inference batch, safe to call from the GUI thread."""
+        self._cancel.set()
+
+    def reportProgress(self, stage, fraction=0.0):
+        from .model_handler import PipelineCancelled, STAGES
+        if self._cancel.is_set():
+            raise PipelineCancelled()
+        self.progress.emit(stage, int(100 * (STAGES.index(stage) + fraction) / len(STAGES)))
+
+    def run(self):
+        # The pipeline modules import pandas and TensorFlow, they are loaded here rather than at startup
+        from Model.data_loader import data_loader
+        from .model_handler import score_data, PipelineCancelled
+
+        try:
+            with labels(file=self.file_path):
+                self.reportProgress("load")
+                new_data = data_loader(self.file_path)
+                scores, predictions = score_data(new_data, self.pressure_threshold, progress=self.reportProgress)
+        except PipelineCancelled:
+            logger.info("Run on %s cancelled", self.file_path)
+            self.cancelled.emit()
+            return
+        except Exception as e:
+            logger.exception("Running the model on %s failed", self.file_path)
+            self.failed.emit(str(e))
+            return
+        self.finished.emit(new_data, predictions, scores)
@@ -0,0 +1,102 @@
+""" Startup of the desktop application: background warm-up of the heavy modules and an import-time report.
+
+The window only needs PyQt5. pandas, matplotlib, scikit-learn and TensorFlow are imported inside the functions
+that use them, and warm_up() imports them in a daemon thread once the window is shown, so they are usually
+loaded by the time the user runs the model. PyInstaller still finds these imports, it also scans function bodies.
+"""
+import logging
+import re
+import subprocess
+import sys
+import threading
+import time
+
+# Imported by warm_up() in this order, the cheap ones first so the plot window is ready early
+WARM_UP_MODULES = [
+    "pandas",
+    "Model.data_loader",
+    "UI_files.model_handler",
+    "UI_files.Results_plot",
+    "tensorflow",
+    "keras",
+]
+# Modules that must not be imported before the window is shown, checked by startup_report()
+HEAVY_MODULES = ("pandas", "matplotlib", "sklearn", "tensorflow", "keras")
+
+_start = time.perf_counter()
+marks = []  # (label, seconds since this module was imported)
+_imported_before_window = set()
+logger = logging.getLogger(__name__)
+
+
+def mark(label: str):
+    """ Records a startup milestone"""
+    marks.append((label, time.perf_counter() - _start))
+
+
+def warm_up(thresholds=None, load_models: bool = True):
+    """ Imports the heavy modules and loads the models in a daemon thread, returns the thread"""
+    def run():
+        import importlib
+        for name in WARM_UP_MODULES:
+            try:
+                importlib.import_module(name)
+            except Exception:
+                logger.exception("Warming up %s failed", name)
+        mark("modules warmed up")
+        if load_models:
+            from Model.model_registry import registry, THRESHOLDS
+            registry.preload(thresholds or THRESHOLDS, background=False)
+            mark("models loaded")
+
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def window_shown():
+    """ Marks the window as shown and notes which heavy modules were imported before it"""
+    mark("window shown")
+    _imported_before_window.update(name for name in HEAVY_MODULES if name in sys.modules)
+
+
+def startup_report():
+    """ Prints the milestones and warns about heavy modules that were imported before the window was shown"""
+    for label, seconds in marks:
+        print(f"{seconds:7.2f} s  {label}")
+    early = [name for name in HEAVY_MODULES if name in _imported_before_window]
+    if early:
+        print(f"Imported before the window was shown: {', '.join(early)}")
+
+
+def import_report(module: str = "UI_files.ui_components", top: int = 20):
+    """
+    Imports a module in a fresh interpreter with -X importtime and returns the slowest imports
+
+    Args:
+        module (str): Module to import
+        top (int): Number of imports returned, all when None
+
+    Returns:
+        imports (list): (cumulative seconds, self seconds, module name), slowest first
+    """
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True).stderr
+    imports = []
+    for line in output.splitlines():
+        found = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)", line)
+        if found:
+            imports.append((int(found.group(2)) / 1e6, int(found.group(1)) / 1e6, found.group(3)))
+    return sorted(imports, reverse=True)[:top]
+
+
+if __name__ == "__main__":
+    module = sys.argv[1] if len(sys.argv) > 1 else "UI_files.ui_components"
+    imports = import_report(module, top=None)
+    print(f"Slowest imports of {module} (cumulative / self):")
+    for cumulative, own, name in imports[:20]:
+        print(f"{cumulative:8.3f} s {own:8.3f} s  {name}")
+    heavy = [name for _, _, name in imports if name in HEAVY_MODULES]
+    if heavy:
+        print(f"Heavy modules imported at startup: {', '.join(heavy)}")
+        sys.exit(1)
@@ -1,15 +1,15 @@
-from PyQt5.QtCore import Qt, QDate
+import logging
+from PyQt5.QtCore import Qt, QDate, QThread
 from PyQt5.QtGui import QDragEnterEvent, QDropEvent
 from PyQt5.QtWidgets import (QMainWindow, QLabel, QPushButton, QVBoxLayout, QWidget, QFileDialog,
                              QRadioButton, QGroupBox, QHBoxLayout, QLineEdit, QApplication, QDesktopWidget,
-                             QDateEdit, QSpinBox, QScrollArea, QComboBox)
+                             QDateEdit, QSpinBox, QScrollArea, QComboBox, QProgressBar)
 
 from .data_selection import DataSelectionLabel
-from .Results_plot import PlotWindow
-from .model_handler import run_model
-from Model.data_loader import data_loader
+from .pipeline_worker import PipelineWorker
 from UI_files.resource_path import resource_path
-import pandas as pd
+
+logger = logging.getLogger(__name__)
 
 
 class MainWindow(QMainWindow):
@@ -21,6 +21,8 @@ class MainWindow(QMainWindow):
         self.offlineHoursInputs = []
         self.clogLocationInputs = []
         self.filePath = None
+        self.worker = None
+        self.workerThread = None
 
     def initUI(self):
         self.setWindowTitle('Anomaly Detection System')
@@ -105,6 +107,25 @@ class MainWindow(QMainWindow):
         self.layout.addWidget(self.runModelButton)
         self.runModelButton.clicked.connect(self.runModel)
 
+        # Progress of a running pipeline, hidden while idle
+        progressLayout = QHBoxLayout()
+        self.progressLabel = QLabel(self)
+        self.progressBar = QProgressBar(self)
+        self.progressBar.setRange(0, 100)
+        self.cancelButton = QPushButton('Cancel', self)
+        self.cancelButton.clicked.connect(self.cancelModel)
+        progressLayout.addWidget(self.progressLabel, 1)
+        progressLayout.addWidget(self.progressBar, 3)
+        progressLayout.addWidget(self.cancelButton)
+        self.layout.addLayout(progressLayout)
+        self.showProgress(False)
+
+    def showProgress(self, visible):
+        self.progressLabel.setVisible(visible)
+        self.progressBar.setVisible(visible)
+        self.cancelButton.setVisible(visible)
+        self.cancelButton.setEnabled(visible)
+
     def initHeaderRow(self):
         headerLayout = QHBoxLayout()
         headerLayout.setContentsMargins(0, 0, 0, -10)
@@ -204,32 +225,77 @@ class MainWindow(QMainWindow):
         self.runModelButton.setEnabled(True)
 
     def runModel(self):
-        print('got to runModel')
-
         resolved_file_path = resource_path(self.filePath)
-        print(resolved_file_path)
-        new_data = data_loader(resolved_file_path)
-        print(new_data.head())
+        logger.info("Running the model on %s", resolved_file_path)
 
         pressure_threshold = float(self.pressureDropdown.currentText())
 
-
         if self.noButton.isChecked():
-            print('no button checked')
-            processed_data, predictions = run_model(resolved_file_path, new_data, pressure_threshold)
-            self.resultWindow = PlotWindow(processed_data, predictions)
-            self.resultWindow.show()
+            self.clogData = None
         else:
             data = {
                 'Date': [dateInput.date().toPyDate() for dateInput in self.dateInputs],
                 'Offline Hours': [offlineHoursInput.value() for offlineHoursInput in self.offlineHoursInputs],
                 'Clog Location': [clogLocationInput.text() for clogLocationInput in self.clogLocationInputs]
             }
-            clog_data = pd.DataFrame(data)
-            processed_data, predictions = run_model(resolved_file_path, new_data, pressure_threshold)
+            import pandas as pd  # Imported on first use, see UI_files/startup.py
+            self.clogData = pd.DataFrame(data)
+
+        # The pipeline runs on a worker thread, the window only receives progress and the results
+        self.workerThread = QThread(self)
+        self.worker = PipelineWorker(resolved_file_path, pressure_threshold)
+        self.worker.moveToThread(self.workerThread)
+        self.workerThread.started.connect(self.worker.run)
+        self.worker.progress.connect(self.onModelProgress)
+        self.worker.finished.connect(self.onModelFinished)
+        self.worker.failed.connect(self.onModelFailed)
+        self.worker.cancelled.connect(self.onModelCancelled)
+        for signal in (self.worker.finished, self.worker.failed, self.worker.cancelled):
+            signal.connect(self.workerThread.quit)
+        self.workerThread.finished.connect(self.worker.deleteLater)
+        self.workerThread.finished.connect(self.workerThread.deleteLater)
+        self.workerThread.finished.connect(self.onWorkerStopped)
 
-            self.resultWindow = PlotWindow(processed_data, predictions, clog_data=clog_data)
-            self.resultWindow.show()
+        self.errorMessageLabel.hide()
+        self.runModelButton.setEnabled(False)
+        self.progressBar.setValue(0)
+        self.progressLabel.setText('Starting')
+        self.showProgress(True)
+        self.workerThread.start()
+
+    def cancelModel(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.cancelButton.setEnabled(False)
+            self.progressLabel.setText('Cancelling...')
+
+    def onModelProgress(self, stage, percent):
+        self.progressLabel.setText(stage.capitalize())
+        self.progressBar.setValue(percent)
+
+    def onModelFinished(self, processed_data, predictions, scores):
+        from .Results_plot import PlotWindow  # Imports matplotlib, usually already warmed up in the background
+        self.resultWindow = PlotWindow(processed_data, predictions, clog_data=self.clogData, scores=scores)
+        self.resultWindow.show()
+
+    def onModelFailed(self, message):
+        self.showErrorMessage(f"Running the model failed: {message}")
+
+    def onModelCancelled(self):
+        self.showErrorMessage("Run cancelled")
+
+    def onWorkerStopped(self):
+        self.worker = None
+        self.workerThread = None
+        self.showProgress(False)
+        self.runModelButton.setEnabled(self.filePath is not None)
+
+    def closeEvent(self, event):
+        if self.workerThread is not None:
+            self.worker.cancel()
+            self.workerThread.quit()
+            self.workerThread.wait()
+        super().closeEvent(event)
 
     def initDateButtons(self):
         dateButtonLayout = QHBoxLayout()
@@ -0,0 +1,179 @@
+""" Headless command line entry point for the detection pipeline, without PyQt.
+
+Examples:
+    python cli.py detect exports/*.csv --output results --format parquet
+    python cli.py detect exports/ --thresholds -0.25 -0.3
+    python cli.py train normal_operation.csv --thresholds -0.25
+    python cli.py train normal_operation.csv --workers 3 --patience 5
+    python cli.py --log-format json --metrics-file metrics.jsonl detect exports/
+"""
+import argparse
+import os
+import re
+import sys
+
+os.environ.setdefault("MPLBACKEND", "Agg")  # No display is needed for the training plots
+
+from Model.data_loader import data_loader
+from Model.model_registry import THRESHOLDS, RUNTIMES, threshold_suffix
+from Model.results import PREDICT_BATCH_SIZE, configure_threads
+from Model.instrumentation import configure_logging
+import pandas as pd
+
+FORMATS = ("csv", "parquet", "json")
+
+
+def input_files(paths):
+    """ Expands directories into the CSV and Excel files they contain"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                if name.endswith(('.csv', '.xlsx'))))
+        else:
+            files.append(path)
+    return files
+
+
+def output_names(file_paths) -> dict:
+    """ A unique name per input file for its result files: the path relative to the directory all inputs share,
+    extension included, e.g. a/line1.csv -> a_line1_csv and b/line1.xlsx -> b_line1_xlsx"""
+    paths = {file_path: os.path.abspath(file_path) for file_path in file_paths}
+    try:
+        root = os.path.commonpath([os.path.dirname(path) for path in paths.values()])
+    except ValueError:  # No shared directory, e.g. files on different drives
+        root = None
+    return {file_path: re.sub(r"[\\/.:]+", "_", os.path.relpath(path, root) if root else path).strip("_")
+            for file_path, path in paths.items()}
+
+
+def write_frame(df: pd.DataFrame, path: str, fmt: str):
+    if fmt == "csv":
+        df.to_csv(path, index=False)
+    elif fmt == "parquet":
+        df.to_parquet(path, index=False)
+    else:
+        df.to_json(path, orient="records", date_format="iso", indent=1)
+
+
+def detect(args) -> int:
+    """ Scores every input file with every threshold, the models are loaded once per process and every file
+    is loaded and cleaned once for all thresholds"""
+    from UI_files.model_handler import score_files  # Imports TensorFlow, once per process
+    from Model.results import anomaly_episodes
+
+    os.makedirs(args.output, exist_ok=True)
+    anomalies = []
+    episodes = []
+    combined = {}  # File -> frame with the scores of all its thresholds side by side
+    failed = 0
+    file_paths = input_files(args.files)
+    names = output_names(file_paths)
+    if len(set(names.values())) < len(names):
+        print("Input files with the same result file names, e.g. a_b/x.csv and a/b_x.csv, rename them first",
+              file=sys.stderr)
+        return 2
+    results = score_files(file_paths, args.thresholds, workers=args.workers,
+                          threads_per_worker=args.threads_per_worker, batch_size=args.batch_size,
+                          runtime=args.runtime)
+    for result in results:
+        if result.failure:
+            print(f"{result.file_path} [{result.pressure_threshold}]: {result.failure}", file=sys.stderr)
+            failed += 1
+            continue
+
+        suffix = threshold_suffix(result.pressure_threshold)
+        write_frame(result.errors.reset_index(),
+                    os.path.join(args.output, f"{names[result.file_path]}_{suffix}_errors.{args.format}"), args.format)
+        anomalies.append(pd.DataFrame({"File": result.file_path, "Threshold": result.pressure_threshold,
+                                       "Date": result.anomalies}))
+        file_episodes = anomaly_episodes(result.errors)
+        episodes.append(file_episodes.assign(File=result.file_path, Threshold=result.pressure_threshold))
+        print(f"{result.file_path} [{result.pressure_threshold}]: {len(result.anomalies)} anomalous timestamps "
+              f"in {len(file_episodes)} episodes")
+        if args.combined:
+            combined[result.file_path] = result.combined  # From score_thresholds
+
+    for file_path, frame in combined.items():
+        # One row per timestamp with the Error, AE, DC and Anomaly of every threshold side by side
+        frame = frame.copy()
+        frame.columns = [f"{column}_{threshold_suffix(threshold)}" for threshold, column in frame.columns]
+        write_frame(frame.reset_index(), os.path.join(args.output, f"{names[file_path]}_combined.{args.format}"),
+                    args.format)
+
+    if anomalies:
+        write_frame(pd.concat(anomalies, ignore_index=True), os.path.join(args.output, f"anomalies.{args.format}"),
+                    args.format)
+        episodes = pd.concat(episodes, ignore_index=True)[["File", "Threshold", "start", "end", "duration", "rows",
+                                                            "peak_error"]]
+        write_frame(episodes, os.path.join(args.output, f"episodes.{args.format}"), args.format)
+    return 1 if failed else 0
+
+
+def train(args) -> int:
+    """ Retrains the models of the given thresholds and writes a training plot and epoch report per model"""
+    from UI_files.model_handler import train_thresholds
+    from Model.model_builder import plot_model
+
+    new_data = data_loader(args.file)
+    options = dict(epochs=args.epochs, batch_size=args.batch_size, learning_rate=args.learning_rate,
+                   patience=args.patience, checkpoint_dir=args.checkpoint_dir or None,
+                   validation_fraction=args.validation_fraction, validation_start=args.validation_start)
+    options = {name: value for name, value in options.items() if value is not None}  # Defaults of train_model
+    histories = train_thresholds(new_data, args.thresholds, workers=args.workers,
+                                 threads_per_worker=args.threads_per_worker, report_dir=args.output, **options)
+    for pressure_threshold, history in histories.items():
+        fig = plot_model(history)
+        fig.savefig(os.path.join(args.output, f"training_{threshold_suffix(pressure_threshold)}.png"))
+        print(f"[{pressure_threshold}] {len(history['loss'])} epochs, {sum(history['epoch_seconds']):.1f} s, "
+              f"best val_loss {min(history.get('val_loss', history['loss'])):.4f}")
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Anomaly detection system, headless batch mode")
+    parser.add_argument("--intra-op", type=int, help="TensorFlow threads inside one operation")
+    parser.add_argument("--inter-op", type=int, help="TensorFlow operations run in parallel")
+    parser.add_argument("--log-level", help="Lowest level logged (INFO)")
+    parser.add_argument("--log-format", choices=["text", "json"], help="Log lines as text or as JSON objects (text)")
+    parser.add_argument("--metrics-file", help="File the timings of every pipeline stage are appended to as JSON lines")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    detect_parser = commands.add_parser("detect", help="Detect anomalies in one or more exports")
+    detect_parser.add_argument("files", nargs="+", help="CSV/Excel exports or directories containing them")
+    detect_parser.add_argument("--thresholds", type=float, nargs="+", default=list(THRESHOLDS))
+    detect_parser.add_argument("--output", default="results", help="Directory for the result files")
+    detect_parser.add_argument("--format", choices=FORMATS, default="csv")
+    detect_parser.add_argument("--batch-size", type=int, default=PREDICT_BATCH_SIZE)
+    detect_parser.add_argument("--workers", type=int, default=1, help="Worker processes, each with its own models")
+    detect_parser.add_argument("--threads-per-worker", type=int, default=1, help="TensorFlow threads per worker")
+    detect_parser.add_argument("--combined", action="store_true",
+                               help="Also write one file per export with the results of all thresholds side by side")
+    detect_parser.add_argument("--runtime", choices=RUNTIMES, default="keras",
+                               help="Keras model or its TFLite export (python -m Model.model_export)")
+    detect_parser.set_defaults(func=detect)
+
+    train_parser = commands.add_parser("train", help="Retrain the models of one or more pressure thresholds")
+    train_parser.add_argument("file")
+    train_parser.add_argument("--thresholds", "--threshold", type=float, nargs="+", default=list(THRESHOLDS))
+    train_parser.add_argument("--output", default="results", help="Directory for the training plots and reports")
+    train_parser.add_argument("--workers", type=int, default=1, help="Thresholds trained at the same time")
+    train_parser.add_argument("--threads-per-worker", type=int, help="TensorFlow threads per worker")
+    train_parser.add_argument("--epochs", type=int, help="Maximum number of epochs (100)")
+    train_parser.add_argument("--batch-size", type=int, help="Windows per training batch (128)")
+    train_parser.add_argument("--learning-rate", type=float, help="Learning rate of the Adam optimizer (0.001)")
+    train_parser.add_argument("--patience", type=int, help="Epochs without a better val_loss before stopping (10)")
+    train_parser.add_argument("--validation-fraction", type=float, help="Last part of the time span for validation (0.05)")
+    train_parser.add_argument("--validation-start", help="First timestamp of the validation period, e.g. 2024-06-01")
+    train_parser.add_argument("--checkpoint-dir", default="checkpoints",
+                              help="Directory for resumable backups, empty to disable")
+    train_parser.set_defaults(func=train)
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    configure_logging(args.log_level, args.log_format, args.metrics_file)
+    if args.intra_op or args.inter_op:
+        configure_threads(args.intra_op, args.inter_op)
+    sys.exit(args.func(args))
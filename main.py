@@ -1,9 +1,12 @@
 import sys
+from UI_files import startup  # First, so the startup milestones are timed from here
 from PyQt5.QtWidgets import QApplication
 from UI_files.ui_components import MainWindow  # Ensure this import is correct
 from UI_files.resource_path import resource_path
+from Model.instrumentation import configure_logging
 
 if __name__ == "__main__":
+    configure_logging()  # ADS_LOG_LEVEL, ADS_LOG_FORMAT and ADS_METRICS_FILE select the level, format and metrics file
     app = QApplication(sys.argv)
 
     # Load the stylesheet using resource_path
@@ -13,4 +16,9 @@ if __name__ == "__main__":
 
     window = MainWindow()
     window.show()
-    sys.exit(app.exec_())
+    startup.window_shown()
+    startup.warm_up()  # Imports pandas, matplotlib and TensorFlow and loads the models while the user picks a file
+    exit_code = app.exec_()
+    if "--startup-report" in sys.argv:
+        startup.startup_report()
+    sys.exit(exit_code)